@@ -0,0 +1,323 @@
+"""
+Timing-accuracy benchmark for the jukebox engine.
+
+Generates a synthetic MIDI corpus (dense chords, rapid tempo changes, 64 tracks, an hour-long
+file), then for each file measures prepare_midi_data (cold/warm time, peak memory) and plays it
+through the real playback_worker tick loop into the recording backend at several speeds,
+reporting note-onset lateness percentiles and CPU use. Results are JSON, so runs can be diffed
+between commits:
+
+    python bench.py --out bench.json
+    python bench.py --cases dense_chords --speeds 1,2 --seconds 3
+    python bench.py --ensemble 3           # three recording windows: per-window lateness and skew
+
+--parsers DIR instead compares the note-only SMF reader with the full mido parse on every MIDI file
+under DIR (throughput, and whether both give the same song):
+
+    python bench.py --parsers midis
+
+--startup instead measures cold start in fresh interpreters: `-X importtime` for `import jukebox`
+(total and the heaviest modules) and how long a snapshot resume takes to be playing:
+
+    python bench.py --startup
+"""
+import argparse
+import bisect
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import mido
+
+import jukebox as jb
+
+# ============================================================================
+# 1. SYNTHETIC CORPUS
+# ============================================================================
+def write_midi(path, tracks, tempo_events=(), ticks_per_beat=480):
+    """tracks: lists of (abs_tick, note, duration); tempo_events: (abs_tick, bpm) on a conductor track."""
+    mid = mido.MidiFile(ticks_per_beat=ticks_per_beat)
+    conductor = mido.MidiTrack(); mid.tracks.append(conductor); last = 0
+    for tick, bpm in sorted(tempo_events):
+        conductor.append(mido.MetaMessage('set_tempo', tempo=mido.bpm2tempo(bpm), time=tick - last)); last = tick
+    for n, notes in enumerate(tracks):
+        track = mido.MidiTrack(); mid.tracks.append(track)
+        channel = n % 16 if n % 16 != 9 else 0 # Keep clear of the drum channel
+        track.append(mido.Message('program_change', program=0, channel=channel, time=0))
+        events = []
+        for tick, note, dur in notes:
+            events.append((tick, 1, note)); events.append((tick + dur, 0, note)) # Offs sort before ons
+        last = 0
+        for tick, on, note in sorted(events):
+            track.append(mido.Message('note_on', note=note, velocity=80 if on else 0, channel=channel, time=tick - last))
+            last = tick
+    mid.save(path)
+
+def gen_dense_chords(rng):
+    """4 tracks of 4-note chords on every 16th at 180 BPM for 90 s: stresses thinning and the rate limit."""
+    tracks = [[] for _ in range(4)]
+    for step in range(90 * 180 * 4 // 60):
+        root = rng.randint(40, 76)
+        for n, track in enumerate(tracks):
+            for k in range(4): track.append((step * 120, root + 3 * k + n, 100))
+    return tracks, [(0, 180)]
+
+def gen_tempo_changes(rng):
+    """One 8th-note melody with a tempo change every half beat (40-300 BPM) for ~2 min."""
+    melody = [(step * 240, rng.randint(48, 83), 200) for step in range(1200)]
+    return [melody], [(step * 240, rng.uniform(40, 300)) for step in range(1200)]
+
+def gen_tracks_64(rng):
+    """64 sparse tracks whose union is dense: 120 BPM for 2 min."""
+    tracks = []
+    for n in range(64):
+        offset = n * 30
+        tracks.append([(offset + step * 1920, rng.randint(36, 96), 400) for step in range(60)])
+    return tracks, [(0, 120)]
+
+def gen_hour_long(rng):
+    """4 tracks of 8th notes at 120 BPM for an hour (57.6k notes); played from the middle."""
+    tracks = [[(step * 240, rng.randint(48, 83), 200) for step in range(3600 * 4)] for _ in range(4)]
+    return tracks, [(0, 120)]
+
+CASES = {
+    # name: (generator, seek fraction)
+    "dense_chords": (gen_dense_chords, 0.0),
+    "tempo_changes": (gen_tempo_changes, 0.0),
+    "tracks_64": (gen_tracks_64, 0.0),
+    "hour_long": (gen_hour_long, 0.5),
+}
+
+# ============================================================================
+# 2. MEASUREMENTS
+# ============================================================================
+def percentile(sorted_vals, q):
+    if not sorted_vals: return None
+    return sorted_vals[min(len(sorted_vals) - 1, int(q * len(sorted_vals)))]
+
+def measure_prepare(path):
+    """Cold (parse + timeline) and warm (memory cache) prepare times, plus the cold pass's peak traced memory."""
+    jb.SONG_CACHE.items.clear(); jb.SONG_CACHE.used = 0
+    t = time.perf_counter(); jb.prepare_midi_data(path); cold = time.perf_counter() - t
+    t = time.perf_counter(); jb.prepare_midi_data(path); warm = time.perf_counter() - t
+
+    # Separate pass: tracemalloc slows allocation down too much to time under it
+    jb.SONG_CACHE.items.clear(); jb.SONG_CACHE.used = 0
+    tracemalloc.start()
+    jb.prepare_midi_data(path)
+    peak = tracemalloc.get_traced_memory()[1]; tracemalloc.stop()
+    return {"prepare_cold_ms": round(cold * 1000, 2), "prepare_warm_ms": round(warm * 1000, 3),
+            "prepare_peak_mb": round(peak / 1048576, 2)}
+
+def measure_playback(path, speed, seconds, seek):
+    """Plays path through playback_worker into a fresh recording sink; lateness is measured per chord (per window in ensemble mode)."""
+    song = jb.load_song(path)
+    jb.state["track_db"][song["digest"]]["speed"] = speed
+    _, timeline, total, *_ = jb.prepare_midi_data(path) # Warm: the measured run starts from the cache
+    actions = timeline["actions"]
+    resume_tick = int(timeline["times"][-1] * seek) if seek else 0
+    start_sec = jb.tick_to_seconds(song["tempo_map"], resume_tick)
+    seconds = min(seconds, (total - start_sec) / speed - 0.5) # Stop before the song ends (no second pass)
+
+    jb.COMMANDS.clear()
+    jb.state.update({"running": True, "paused": False, "muted": False, "looping": False,
+                     "playlist": [path], "current_index": 0, "manual_track_indices": None,
+                     "resume_from_tick": resume_tick, "clock": None,
+                     "output": jb.RecordingBackend({h: jb.CONFIG["window_title"] for h in range(1, max(jb.CONFIG["ensemble_parts"], 1) + 1)})})
+    jb.ENSEMBLE.reset()
+    cpu0 = time.process_time(); wall0 = time.perf_counter()
+    worker = threading.Thread(target=jb.playback_worker, daemon=True); worker.start()
+    time.sleep(seconds)
+    jb.state["running"] = False; jb.COMMANDS.put("stop"); worker.join(5)
+    cpu = (time.process_time() - cpu0) / (time.perf_counter() - wall0)
+    if jb.CONFIG["ensemble_parts"] > 1: # Windows interleave in the sink: use the parts' own histograms
+        return {"speed": speed, "seconds": round(seconds, 2), "messages": len(jb.get_output().events), "cpu": round(cpu, 3),
+                "ensemble": jb.ENSEMBLE.summary()}
+
+    # Recording sink stamps a chord's batch once, so chord i starts at event start[i] - start[first]
+    clock = jb.state["clock"]; events = jb.get_output().events
+    first = bisect.bisect_left(actions["ticks"], resume_tick); late = []
+    for i in range(first, len(actions["ticks"])):
+        e = actions["start"][i] - actions["start"][first]
+        if e >= len(events): break
+        due = clock.origin + (actions["secs"][i] - clock.origin_sec) / clock.speed
+        late.append((events[e][0] - due) * 1000)
+    late.sort()
+    return {
+        "speed": speed, "seconds": round(seconds, 2), "chords": len(late), "messages": len(events),
+        "lateness_ms": {k: round(v, 3) if v is not None else None for k, v in
+                        (("p50", percentile(late, 0.50)), ("p99", percentile(late, 0.99)), ("max", late[-1] if late else None))},
+        "cpu": round(cpu, 3),
+        "thinned": jb.state["dashboard"]["thinned"], "delayed": jb.state["dashboard"]["delayed"],
+    }
+
+def measure_parsers(root, repeat=3):
+    """Best-of-repeat wall time per file for read_smf and the mido path, over every MIDI file under root."""
+    paths = sorted(os.path.join(d, f) for d, _, files in os.walk(root) for f in files if jb.is_midi_file(f))
+    keys = ("ticks_per_beat", "tempo_map", "track_ticks", "track_pitches", "track_info")
+    totals = {"read_smf": 0.0, "mido": 0.0}; size = notes = 0
+    counts = {"same": 0, "different": 0, "mido_only": 0, "read_smf_only": 0, "unreadable": 0}
+    for path in paths:
+        songs = {}
+        for name, parse in (("read_smf", jb.read_smf), ("mido", jb.parse_song_mido)):
+            best = None
+            for _ in range(repeat):
+                t = time.perf_counter(); songs[name] = parse(path); dt = time.perf_counter() - t
+                best = dt if best is None else min(best, dt)
+            totals[name] += best
+        fast, full = songs["read_smf"], songs["mido"]
+        if fast and full: counts["same" if all(fast[k] == full[k] for k in keys) else "different"] += 1
+        elif full: counts["mido_only"] += 1 # read_smf declined: parse_song falls back to mido
+        elif fast: counts["read_smf_only"] += 1 # mido raises (e.g. an invalid key signature)
+        else: counts["unreadable"] += 1
+        song = fast or full
+        if song: size += os.path.getsize(path); notes += sum(len(t) for t in song["track_ticks"])
+    return {
+        "files": len(paths), "mb": round(size / 1048576, 2), "notes": notes, **counts,
+        "parsers": {name: {"total_ms": round(sec * 1000, 1), "mb_per_s": round(size / 1048576 / sec, 2) if sec else None,
+                           "notes_per_s": round(notes / sec) if sec else None} for name, sec in totals.items()},
+        "speedup": round(totals["mido"] / totals["read_smf"], 1) if totals["read_smf"] else None,
+    }
+
+STARTUP_CHILD = """
+import time; t0 = time.perf_counter()
+import json, sys, threading
+import jukebox as jb
+t_import = time.perf_counter()
+jb.CONFIG.update(json.loads(sys.argv[1]))
+jb.load_track_db_async(); point = jb.load_resume_snapshot()
+threading.Thread(target=jb.playback_worker, daemon=True).start()
+jb.COMMANDS.put("resume", point)
+while jb.state["clock"] is None: time.sleep(0.0002)
+t_ready = time.perf_counter()
+while jb.state["dashboard"]["start_ms"] is None and time.perf_counter() - t_ready < 2: time.sleep(0.001)
+print(json.dumps({"import_ms": (t_import - t0) * 1000, "resume_ms": (t_ready - t0) * 1000,
+                  "source": jb.state["dashboard"]["load_source"]}))
+"""
+
+def measure_startup(corpus, repeat=5):
+    """
+    Best-of-repeat cold start in fresh interpreters: `-X importtime` for `import jukebox`, and the time
+    from the first line of a script to a snapshot resume playing (import + read snapshot + player started).
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    path = os.path.join(corpus, "startup.mid")
+    if not os.path.exists(path):
+        tracks, tempos = gen_tempo_changes(random.Random(1)); write_midi(path, tracks, tempos)
+    config = {k: jb.CONFIG[k] for k in ("output_backend", "db_file", "legacy_db_file")}
+    config.update(cache_dir=os.path.join(corpus, "cache"), resume_file=os.path.join(corpus, "resume.jkr"))
+    jb.CONFIG.update(config)
+    song, timeline, *_ = jb.prepare_midi_data(path) # Warms the disk cache, as any played song would have
+    jb.state.update({"playlist": [path], "current_index": 0, "manual_track_indices": None, "now_playing": (song, timeline),
+                     "resume_from_tick": timeline["times"][len(timeline["times"]) // 2]})
+    jb.save_resume_snapshot()
+
+    imports = []; runs = []
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import jukebox"], capture_output=True, text=True, cwd=here)
+        rows = {}
+        for line in proc.stderr.splitlines(): # import time: self [us] | cumulative | imported package
+            if not line.startswith("import time:") or "cumulative" in line: continue
+            own, cumulative, name = line[len("import time:"):].split("|")
+            rows[name.strip()] = (int(own), int(cumulative))
+        imports.append(rows)
+        started = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-c", STARTUP_CHILD, json.dumps(config)], capture_output=True, text=True, cwd=here)
+        run = json.loads(proc.stdout); run["process_ms"] = (time.perf_counter() - started) * 1000
+        runs.append(run)
+    best = min(imports, key=lambda rows: rows["jukebox"][1])
+    heaviest = sorted(((name, own) for name, (own, _) in best.items()), key=lambda r: -r[1])[:8]
+    return {
+        "import_jukebox_ms": round(best["jukebox"][1] / 1000, 2),
+        "import_self_ms": {name: round(own / 1000, 2) for name, own in heaviest},
+        "heavy_modules_loaded": sorted(m for m in ("mido", "keyboard", "win32api", "win32gui", "concurrent.futures") if m in best),
+        "resume": {k: round(min(r[k] for r in runs), 2) for k in ("import_ms", "resume_ms", "process_ms")},
+        "first_note_source": runs[0]["source"], # memory = the snapshot's timeline was used, no merge
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError: # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1048576 if sys.platform == "darwin" else 1024), 1)
+
+# ============================================================================
+# 3. MAIN
+# ============================================================================
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Timing-accuracy benchmark (synthetic corpus, recording sink).")
+    parser.add_argument("--cases", default=",".join(CASES), help="comma-separated subset of: " + ", ".join(CASES))
+    parser.add_argument("--speeds", default="0.5,1.0,2.0", help="comma-separated playback speeds")
+    parser.add_argument("--seconds", type=float, default=5.0, help="wall-clock playback per case and speed")
+    parser.add_argument("--corpus", help="directory for the generated MIDI files (default: a temp dir)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--ensemble", type=int, default=0, metavar="N", help="play every case on N windows (ensemble mode)")
+    parser.add_argument("--parsers", metavar="DIR", help="benchmark the MIDI readers on the files under DIR instead")
+    parser.add_argument("--startup", action="store_true", help="measure import time and snapshot resume instead")
+    parser.add_argument("--out", help="write the JSON here instead of stdout")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.parsers:
+        results = {"revision": git_revision(), "python": platform.python_version(), "platform": sys.platform,
+                   "parsers": measure_parsers(args.parsers)}
+        return write_results(results, args.out)
+    corpus = args.corpus or tempfile.mkdtemp(prefix="jukebox_bench_")
+    os.makedirs(corpus, exist_ok=True)
+    jb.CONFIG.update({"output_backend": "record", "cache_dir": None, "ensemble_parts": args.ensemble,
+                      "db_file": os.path.join(corpus, "track_selections.db"),
+                      "legacy_db_file": None})
+    if args.startup:
+        results = {"revision": git_revision(), "python": platform.python_version(), "platform": sys.platform,
+                   "startup": measure_startup(corpus)}
+        return write_results(results, args.out)
+    speeds = [float(s) for s in args.speeds.split(",")]
+
+    results = {"revision": git_revision(), "python": platform.python_version(), "platform": sys.platform,
+               "config": {k: jb.CONFIG[k] for k in ("spin_margin", "ui_refresh", "rate_limit_msgs", "rate_limit_window",
+                                                   "note_hold_time", "chord_strum_delay", "ensemble_parts")},
+               "cases": []}
+    for name in args.cases.split(","):
+        gen, seek = CASES[name]
+        path = os.path.join(corpus, f"{name}.mid")
+        if not os.path.exists(path):
+            tracks, tempos = gen(random.Random(args.seed))
+            write_midi(path, tracks, tempos)
+        print(f"{name}...", file=sys.stderr)
+        song = jb.load_song(path)
+        jb.state["track_db"] = {song["digest"]: {"tracks": [t["index"] for t in song["track_info"]]}} # Play every track
+        case = {"name": name, "tracks": len(song["track_info"]), "notes": sum(t["notes"] for t in song["track_info"]),
+                "duration": round(jb.tick_to_seconds(song["tempo_map"], max((t[-1] for t in song["track_ticks"] if len(t)), default=0)), 1),
+                "seek": seek}
+        case.update(measure_prepare(path))
+        case["runs"] = [measure_playback(path, speed, args.seconds, seek) for speed in speeds]
+        results["cases"].append(case)
+    results["peak_rss_mb"] = peak_rss_mb()
+    write_results(results, args.out)
+
+def write_results(results, out):
+    text = json.dumps(results, indent=2)
+    if out:
+        with open(out, "w") as f: f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
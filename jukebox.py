@@ -1,15 +1,26 @@
 import ctypes
 import time
-import mido
 import os
-import keyboard
-import win32gui
-import win32con
-import win32api
 import sys
 import json
 import threading
-from ctypes import wintypes
+import argparse
+import atexit
+import sqlite3
+import shutil
+import queue
+import hashlib
+import mmap
+import struct
+import bisect
+import heapq
+import itertools
+import operator
+import gc
+import re
+import unicodedata
+from array import array
+from collections import OrderedDict, Counter, deque
 
 # ============================================================================
 # 1. CONFIGURATION
@@ -17,16 +28,48 @@ from ctypes import wintypes
 CONFIG = {
     "midi_root": "midis",         
     "window_title": "Where Winds Meet", 
-    "db_file": "track_selections.json",
+    "output_backend": "win32",    # win32 (PostMessage to the game) | record | null (headless)
+    "ensemble_parts": 0,          # >1: play on that many game windows (all matching window_title) from one clock
+    "ensemble_switch_interval": 0.0002, # GIL switch interval while an ensemble plays (parts' threads wake faster)
+    "ensemble_max_lag": 0.25,     # A window that falls this far behind (s) skips chords to catch up with the others
+    "db_file": "track_selections.db", # SQLite: saved track mix / speed / transposition per song
+    "legacy_db_file": "track_selections.json", # Imported into db_file once, when the store is created
     
     # Input Tuning
     "note_hold_time": 0,          
     "chord_strum_delay": 0,
+    "auto_transpose": True,       # Shift/fold notes outside NOTE_MAP into range (False = drop them)
     
     # Controls
     "speed_step": 0.1,            
     "seek_step": 10.0,
     "fine_seek_step": 1.0,
+
+    # Scheduler
+    "spin_margin": 0.002,         # Final busy-wait before each note (s); coarse sleep before that
+    "ui_refresh": 0.05,           # Renderer frame interval (s); the player never wakes for the UI
+    "rate_limit_msgs": 16,        # Output budget: at most this many key messages...
+    "rate_limit_window": 0.016,   # ...per this many seconds (~1 game frame); 0 = unlimited
+
+    # Instrumentation
+    "stats_ring": 4096,           # Per-chord timing rows kept per song (oldest overwritten)
+    "stats_dump": None,           # "csv" / "json": write each song's timing to stats_dir when it ends
+    "stats_dir": "stats",
+    "stats_gc": True,             # Also time garbage-collector pauses
+
+    # Caching
+    "cache_max_mb": 64,           # In-memory budget for parsed songs + timelines
+    "cache_dir": ".jukebox_cache", # Compiled songs on disk, keyed by content hash (None = off)
+    "prefetch": True,             # Prepare next/previous playlist entries in the background
+    "resume_file": ".jukebox_cache/resume.jkr", # Playlist, position and timeline at exit, for --resume / [R] (None = off)
+
+    # Library
+    "library_db": "library.db",   # SQLite index of midi_root (rebuildable cache)
+    "library_workers": 1,         # Processes for background metadata extraction (`analyze` uses all cores)
+
+    # Auto-mix (used when a song has no saved/manual track selection)
+    "mix_keys_per_sec": 24,       # Budget: busiest second of the chosen tracks may not exceed this
+    "mix_min_gain": 0.05,         # Stop adding tracks whose new notes are < this share of the lead's
 }
 
 # ============================================================================
@@ -39,13 +82,8 @@ state = {
     "looping": False,
     "running": True,
     
-    # Triggers
-    "restart_flag": False,        
-    "request_selection": False,   
-    "request_track_mixer": False, 
-    "seek_request": None,
-    "mixer_ready_event": threading.Event(),
-    "player_ready_for_mixer": threading.Event(), 
+    # Controls arrive as commands (COMMANDS / UI_COMMANDS); only the player thread writes playback state
+    "control_at": None,           # When the seek/skip being applied was requested, until playback resumes
     
     # Playback Data
     "current_index": 0,
@@ -58,14 +96,21 @@ state = {
     "resume_from_tick": 0,
     
     # Persistence
-    "track_db": {}, 
-    "game_hwnd": None,
+    "track_db": {},               # Content digest -> saved selection (mirror of db_file; see save_selection)
+    "legacy_track_db": {},        # File name -> selection imported from legacy_db_file, until the song is saved
+    "resume_point": None,         # Last session read from resume_file (playlist, index, tick, ...), until something plays
+    "output": None,               # Active OutputBackend, created on first use
+    "clock": None,                # PlaybackClock of the song being played (read by bench.py)
+    "now_playing": None,          # (song, timeline) being played, for the resume snapshot
     
-    # UI Buffer
+    # UI Snapshot: raw values only, written by the player and formatted by the renderer thread
     "dashboard": {
-        "st": "STOPPED", "bar": "", 
-        "curr": "00:00", "tot": "00:00", 
-        "spd": "1.0", "song": "", "mixer": ""
+        "song": "", "total": 0.0,     # Path being played, its length (s)
+        "paused_at": None,            # Song position while paused (else the renderer reads the clock)
+        "mix": None,                  # (source, indices, playable tracks, msgs, saved, transpose, folded)
+        "ensemble": None,             # [(window number, tracks, has window)] in ensemble mode
+        "start_ms": None, "load_source": "", # First-note latency and where the song came from
+        "thinned": 0, "delayed": 0    # Notes dropped at prepare time / held back by the rate limiter
     }
 }
 
@@ -110,99 +155,442 @@ GM_INSTRUMENTS = {
 # ============================================================================
 # 4. DB & INPUT LOGIC
 # ============================================================================
+TRACK_DB_SCHEMA_VERSION = 2
+TRACK_DB_WRITES = queue.Queue()   # (digest, entry) for the writer thread; None = flush and exit
+TRACK_DB_WRITER = {"thread": None}
+TRACK_DB_LOCK = threading.Lock()
+TRACK_DB_READY = threading.Event() # Cleared while load_track_db_async runs; readers of state["track_db"] wait on it
+TRACK_DB_READY.set()
+
+def open_track_db():
+    """
+    Connection to the selection store. Unlike the library index this is user data: schema changes
+    must migrate, never drop. A new store imports legacy_db_file (bare track lists or dicts) by name.
+    """
+    con = sqlite3.connect(CONFIG["db_file"], timeout=10, isolation_level=None) # Transactions are explicit
+    con.execute("PRAGMA journal_mode=WAL"); con.execute("PRAGMA synchronous=NORMAL")
+    if con.execute("PRAGMA user_version").fetchone()[0] < TRACK_DB_SCHEMA_VERSION:
+        con.execute("BEGIN IMMEDIATE")
+        version = con.execute("PRAGMA user_version").fetchone()[0] # Another connection may have won the race
+        if version < 1:
+            con.execute("""CREATE TABLE IF NOT EXISTS selections (
+                digest TEXT PRIMARY KEY, name TEXT NOT NULL, speed REAL, transpose INTEGER, updated REAL)""")
+            con.execute("""CREATE TABLE IF NOT EXISTS selection_tracks (
+                digest TEXT NOT NULL REFERENCES selections(digest), track INTEGER NOT NULL,
+                PRIMARY KEY (digest, track)) WITHOUT ROWID""")
+            con.execute("""CREATE TABLE IF NOT EXISTS legacy_selections (
+                name TEXT PRIMARY KEY, tracks TEXT, speed REAL, transpose INTEGER)""")
+            con.executemany("INSERT OR REPLACE INTO legacy_selections VALUES (?, ?, ?, ?)",
+                            [(name, json.dumps(e["tracks"]), e["speed"], e["transpose"]) for name, e in read_legacy_track_db().items()])
+        if version < 2: # Ensemble mode: which window (part) plays which track
+            con.execute("""CREATE TABLE IF NOT EXISTS selection_parts (
+                digest TEXT NOT NULL REFERENCES selections(digest), part INTEGER NOT NULL, track INTEGER NOT NULL,
+                PRIMARY KEY (digest, part, track)) WITHOUT ROWID""")
+        con.execute(f"PRAGMA user_version = {TRACK_DB_SCHEMA_VERSION}")
+        con.execute("COMMIT")
+    return con
+
+def read_legacy_track_db():
+    """track_selections.json -> {name: entry}. Old files map a name to a bare track list; newer ones to a dict."""
+    path = CONFIG["legacy_db_file"]
+    if not path or not os.path.exists(path): return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f: data = json.load(f)
+    except (OSError, ValueError): return {}
+    entries = {}
+    for name, value in data.items():
+        if isinstance(value, list): value = {"tracks": value}
+        if not isinstance(value, dict): continue
+        entries[name] = {"name": name, "tracks": value.get("tracks") or None,
+                         "speed": value.get("speed"), "transpose": value.get("transpose")}
+    return entries
+
 def load_track_db():
-    if os.path.exists(CONFIG["db_file"]):
+    """Reads the whole store into state (a few hundred bytes per song); later changes go through save_selection."""
+    con = open_track_db()
+    try:
+        db = {digest: {"name": name, "tracks": None, "speed": speed, "transpose": transpose, "parts": None}
+              for digest, name, speed, transpose in con.execute("SELECT digest, name, speed, transpose FROM selections")}
+        for digest, track in con.execute("SELECT digest, track FROM selection_tracks ORDER BY digest, track"):
+            entry = db[digest]
+            if entry["tracks"] is None: entry["tracks"] = []
+            entry["tracks"].append(track)
+        for digest, part, track in con.execute("SELECT digest, part, track FROM selection_parts ORDER BY digest, part, track"):
+            parts = db[digest]["parts"]
+            if parts is None: parts = db[digest]["parts"] = []
+            while len(parts) <= part: parts.append([])
+            parts[part].append(track)
+        legacy = {name: {"name": name, "tracks": json.loads(tracks), "speed": speed, "transpose": transpose}
+                  for name, tracks, speed, transpose in con.execute("SELECT * FROM legacy_selections")}
+    finally:
+        con.close()
+    state["track_db"] = db; state["legacy_track_db"] = legacy
+
+def load_track_db_async():
+    """Loads the store on a thread so the menu is not held up by it (or by a first-run legacy import)."""
+    TRACK_DB_READY.clear()
+    def run():
+        try: load_track_db()
+        finally: TRACK_DB_READY.set() # Even if the store is unreadable: play with no saved selections
+    threading.Thread(target=run, daemon=True).start()
+
+def get_selection(song, full_path):
+    """Saved entry for a song (by content, so renames keep it), else its legacy entry by file name, else {}."""
+    TRACK_DB_READY.wait()
+    entry = state["track_db"].get(song["digest"])
+    if entry is None: entry = state["legacy_track_db"].get(os.path.basename(full_path))
+    return entry or {}
+
+def save_selection(song, full_path, **fields):
+    """
+    Updates a song's entry (tracks / speed / transpose / ensemble parts) in memory and queues it for the writer thread,
+    so neither the player nor the mixer ever waits on disk.
+    """
+    entry = dict(get_selection(song, full_path)); entry.update(fields)
+    entry["name"] = os.path.basename(full_path)
+    state["track_db"][song["digest"]] = entry
+    start_track_db_writer()
+    TRACK_DB_WRITES.put((song["digest"], dict(entry)))
+
+def start_track_db_writer():
+    with TRACK_DB_LOCK:
+        if TRACK_DB_WRITER["thread"] is None:
+            TRACK_DB_WRITER["thread"] = threading.Thread(target=track_db_writer, daemon=True)
+            TRACK_DB_WRITER["thread"].start()
+            atexit.register(flush_track_db) # Daemon thread: drain the queue before the interpreter kills it
+
+def track_db_writer():
+    """Drains TRACK_DB_WRITES; each batch (latest entry per song) is one transaction, so the store is never half-written."""
+    con = open_track_db(); running = True
+    while running:
+        batch = {}; item = TRACK_DB_WRITES.get()
+        while item is not None:
+            batch[item[0]] = item[1]
+            try: item = TRACK_DB_WRITES.get_nowait()
+            except queue.Empty: break
+        running = item is not None
+        if not batch: continue
         try:
-            with open(CONFIG["db_file"], "r") as f: state["track_db"] = json.load(f)
-        except: state["track_db"] = {}
-    else: state["track_db"] = {}
+            con.execute("BEGIN IMMEDIATE"); now = time.time()
+            for digest, entry in batch.items():
+                con.execute("INSERT OR REPLACE INTO selections VALUES (?, ?, ?, ?, ?)",
+                            (digest, entry["name"], entry.get("speed"), entry.get("transpose"), now))
+                con.execute("DELETE FROM selection_tracks WHERE digest = ?", (digest,))
+                con.executemany("INSERT OR IGNORE INTO selection_tracks VALUES (?, ?)",
+                                [(digest, int(t)) for t in entry.get("tracks") or ()])
+                con.execute("DELETE FROM selection_parts WHERE digest = ?", (digest,))
+                con.executemany("INSERT OR IGNORE INTO selection_parts VALUES (?, ?, ?)",
+                                [(digest, p, int(t)) for p, tracks in enumerate(entry.get("parts") or ()) for t in tracks])
+            con.execute("COMMIT")
+        except sqlite3.Error:
+            if con.in_transaction: con.execute("ROLLBACK") # Still in state["track_db"]; the song's next save writes it again
+    con.close()
 
-def save_track_db():
-    try:
-        with open(CONFIG["db_file"], "w") as f: json.dump(state["track_db"], f, indent=4)
-    except: pass
+def flush_track_db(timeout=5.0):
+    """Waits for queued selection writes to reach disk (at exit)."""
+    with TRACK_DB_LOCK:
+        thread = TRACK_DB_WRITER["thread"]; TRACK_DB_WRITER["thread"] = None
+    if thread is None: return
+    TRACK_DB_WRITES.put(None); thread.join(timeout)
 
+WM_KEYDOWN = 0x0100; WM_KEYUP = 0x0101
 SC_LSHIFT = 0x2A; SC_LCTRL = 0x1D
 SCAN_CODES = { 'z':0x2C,'x':0x2D,'c':0x2E,'v':0x2F,'b':0x30,'n':0x31,'m':0x32,'a':0x1E,'s':0x1F,'d':0x20,'f':0x21,'g':0x22,'h':0x23,'j':0x24,'q':0x10,'w':0x11,'e':0x12,'r':0x13,'t':0x14,'y':0x15,'u':0x16 }
 NOTE_MAP = {48:(None,'z'),49:('shift','z'),50:(None,'x'),51:('ctrl','c'),52:(None,'c'),53:(None,'v'),54:('shift','v'),55:(None,'b'),56:('shift','b'),57:(None,'n'),58:('ctrl','m'),59:(None,'m'),60:(None,'a'),61:('shift','a'),62:(None,'s'),63:('ctrl','d'),64:(None,'d'),65:(None,'f'),66:('shift','f'),67:(None,'g'),68:('shift','g'),69:(None,'h'),70:('ctrl','j'),71:(None,'j'),72:(None,'q'),73:('shift','q'),74:(None,'w'),75:('ctrl','e'),76:(None,'e'),77:(None,'r'),78:('shift','r'),79:(None,'t'),80:('shift','t'),81:(None,'y'),82:('ctrl','u'),83:(None,'u')}
 
-def press_atomic(modifier, key_char):
-    hwnd = state.get("game_hwnd")
-    if not hwnd: return
+NOTE_LOW = min(NOTE_MAP); NOTE_HIGH = max(NOTE_MAP)
+ACT_STRUM = 2 # Action flag: a note's key down (takes a chord_strum_delay slot; counted when the rate limit delays it)
+
+MODIFIER_KEYS = {'shift': (0xA0, 0x002A0001, 0xC02A0001), 'ctrl': (0xA2, 0x001D0001, 0xC01D0001)} # vk, lParam down, lParam up
+MODIFIER_ORDER = (None, 'shift', 'ctrl') # Unmodified keys first, then each modifier exactly once
+
+def group_actions(modifier, key_chars):
+    """
+    The (msg, wparam, lparam, flags) records for tapping several keys under a single press of
+    modifier: mod down, all key downs, all key ups, mod up.
+    """
+    codes = []
+    for key_char in key_chars:
+        sc_key = SCAN_CODES.get(key_char.lower(), 0)
+        if sc_key: codes.append((ord(key_char.upper()), sc_key))
+    if not codes: return ()
+
+    recs = []
+    if modifier: recs.append((WM_KEYDOWN, MODIFIER_KEYS[modifier][0], MODIFIER_KEYS[modifier][1], 0))
+    for vk_key, sc_key in codes:
+        recs.append((WM_KEYDOWN, vk_key, 1 | (sc_key << 16), ACT_STRUM))
+    for vk_key, sc_key in codes:
+        recs.append((WM_KEYUP, vk_key, 1 | (sc_key << 16) | 0xC0000001, 0))
+    if modifier: recs.append((WM_KEYUP, MODIFIER_KEYS[modifier][0], MODIFIER_KEYS[modifier][2], 0))
+    return tuple(recs)
 
-    sc_key = SCAN_CODES.get(key_char.lower(), 0)
-    vk_key = ord(key_char.upper())
-    if sc_key == 0: return
+# ============================================================================
+# 5. OUTPUT BACKENDS & WINDOW
+# ============================================================================
+class OutputBackend:
+    """
+    Where key messages go. The tick loops only talk to this interface,
+    so the playback engine imports and runs without pywin32 / keyboard.
+    The target window is found once by enumerating windows, then cached: get_target() only checks
+    that it still exists and still has the right title, and re-resolves in the background if not.
+    """
+    name = "base"
+    interactive = False           # True = real desktop: register global hotkeys
 
-    def pm(msg, w, l):
-        win32api.PostMessage(hwnd, msg, w, l)
+    def __init__(self):
+        self.target = None
+        self.resolve_attempts = 0; self.resolve_failures = 0
+        self.resolving = threading.Lock() # Held while a background re-resolve runs
 
-    if modifier == 'shift': 
-        pm(win32con.WM_KEYDOWN, 0xA0, 0x002A0001) 
-    elif modifier == 'ctrl': 
-        pm(win32con.WM_KEYDOWN, 0xA2, 0x001D0001)
+    # --- Window registry (overridden per platform) ---
+    def list_windows(self):
+        """(handle, title) for every top-level window. Expensive: only used to (re)resolve."""
+        return []
 
-    lparam_down = 1 | (sc_key << 16)
-    pm(win32con.WM_KEYDOWN, vk_key, lparam_down)
+    def window_title(self, handle):
+        """Title of handle, or None if that window no longer exists. Cheap: used to validate."""
+        return None
 
-    if CONFIG["note_hold_time"] > 0: time.sleep(CONFIG["note_hold_time"])
+    # --- Target cache ---
+    def find_target(self):
+        """Enumerates every window for one whose title contains window_title (counted)."""
+        self.resolve_attempts += 1
+        want = CONFIG["window_title"].lower()
+        for handle, title in self.list_windows():
+            if want in title.lower(): return handle
+        self.resolve_failures += 1
+        return None
 
-    lparam_up = 1 | (sc_key << 16) | 0xC0000001
-    pm(win32con.WM_KEYUP, vk_key, lparam_up)
+    def find_targets(self, count):
+        """Up to count windows matching window_title, in handle order so each keeps its part across lookups."""
+        self.resolve_attempts += 1
+        want = CONFIG["window_title"].lower()
+        handles = sorted(handle for handle, title in self.list_windows() if want in title.lower())[:count]
+        if len(handles) < count: self.resolve_failures += 1
+        return handles
 
-    if modifier == 'shift': pm(win32con.WM_KEYUP, 0xA0, 0xC02A0001)
-    elif modifier == 'ctrl': pm(win32con.WM_KEYUP, 0xA2, 0xC01D0001)
+    def is_valid(self, handle):
+        if handle is None: return False
+        title = self.window_title(handle)
+        return title is not None and CONFIG["window_title"].lower() in title.lower()
 
-# ============================================================================
-# 5. WINDOW & FOCUS
-# ============================================================================
-def get_game_hwnd():
-    toplist = []; 
-    def enum_win(hwnd, result): toplist.append((hwnd, win32gui.GetWindowText(hwnd)))
-    win32gui.EnumWindows(enum_win, toplist)
-    for (hwnd, title) in toplist:
-        if CONFIG["window_title"].lower() in title.lower(): return hwnd
-    return None
+    def get_target(self):
+        """
+        The cached window if it is still valid. Otherwise: resolve inline the very first time,
+        later kick off a background re-resolve and return None until it lands in self.target.
+        """
+        if self.is_valid(self.target): return self.target
+        self.target = None
+        if not self.resolve_attempts:
+            self.target = self.find_target()
+        elif self.resolving.acquire(blocking=False):
+            def resolve():
+                try: self.target = self.find_target()
+                finally: self.resolving.release()
+            threading.Thread(target=resolve, daemon=True).start()
+        return self.target
+
+    # --- Output ---
+    def send(self, target, msg, wparam, lparam):
+        raise NotImplementedError
+
+    def send_batch(self, target, msgs, wparams, lparams, start, end):
+        """Posts records start:end of the compiled arrays back-to-back (one chord)."""
+        send = self.send
+        for j in range(start, end): send(target, msgs[j], wparams[j], lparams[j])
+
+class Win32Backend(OutputBackend):
+    """Posts WM_KEYDOWN/WM_KEYUP straight into the game window's queue."""
+    name = "win32"
+    interactive = True
+
+    def __init__(self):
+        super().__init__()
+        import win32api, win32gui
+        self.post_message = win32api.PostMessage
+        self.win32gui = win32gui
+        # Ask Windows for 1 ms timer granularity so the scheduler's coarse sleeps land close to target
+        ctypes.windll.winmm.timeBeginPeriod(1)
+
+    def list_windows(self):
+        toplist = []
+        def enum_win(hwnd, result): toplist.append((hwnd, self.win32gui.GetWindowText(hwnd)))
+        self.win32gui.EnumWindows(enum_win, toplist)
+        return toplist
+
+    def window_title(self, handle):
+        if not self.win32gui.IsWindow(handle): return None
+        return self.win32gui.GetWindowText(handle)
+
+    def send(self, target, msg, wparam, lparam):
+        self.post_message(target, msg, wparam, lparam)
+
+    def send_batch(self, target, msgs, wparams, lparams, start, end):
+        # SendInput would batch into the *foreground* window; PostMessage is what lets us target
+        # a background game window, so batch by keeping the whole chord in one tight local loop.
+        post = self.post_message
+        for j in range(start, end): post(target, msgs[j], wparams[j], lparams[j])
+
+class HeadlessBackend(OutputBackend):
+    """
+    No desktop: windows come from a fake registry {handle: title}, by default one window with
+    the configured title. Tests can close / retitle / reopen windows to exercise the target cache.
+    """
+    def __init__(self, windows=None):
+        super().__init__()
+        self.windows = {1: CONFIG["window_title"]} if windows is None else windows
+
+    def list_windows(self):
+        return list(self.windows.items())
+
+    def window_title(self, handle):
+        return self.windows.get(handle)
+
+class RecordingBackend(HeadlessBackend):
+    """Headless sink that keeps (perf_counter, msg, wparam, lparam, target) for every message."""
+    name = "record"
+
+    def __init__(self, windows=None):
+        super().__init__(windows)
+        self.events = []
+
+    def send(self, target, msg, wparam, lparam):
+        self.events.append((time.perf_counter(), msg, wparam, lparam, target))
+
+    def send_batch(self, target, msgs, wparams, lparams, start, end):
+        now = time.perf_counter()
+        self.events.extend((now, msgs[j], wparams[j], lparams[j], target) for j in range(start, end))
+
+class NullBackend(HeadlessBackend):
+    """Headless sink that drops everything (pure engine overhead)."""
+    name = "null"
+
+    def send(self, target, msg, wparam, lparam):
+        pass
+
+    def send_batch(self, target, msgs, wparams, lparams, start, end):
+        pass
+
+OUTPUT_BACKENDS = {"win32": Win32Backend, "record": RecordingBackend, "null": NullBackend}
+
+OUTPUT_LOCK = threading.Lock() # First use may come from the player, the prefetcher or startup at once
+
+def get_output():
+    if state["output"] is None:
+        with OUTPUT_LOCK:
+            if state["output"] is None: state["output"] = OUTPUT_BACKENDS[CONFIG["output_backend"]]()
+    return state["output"]
 
 # ============================================================================
 # 6. HOTKEYS & CONTROLS
 # ============================================================================
-def next_song():
-    if not state["playlist"]: return
-    state["current_index"] = (state["current_index"] + 1) % len(state["playlist"])
-    state["restart_flag"] = True; state["manual_track_indices"] = None; state["resume_from_tick"] = 0
-def prev_song():
-    if not state["playlist"]: return
-    state["current_index"] = (state["current_index"] - 1) % len(state["playlist"])
-    state["restart_flag"] = True; state["manual_track_indices"] = None; state["resume_from_tick"] = 0
-
-def toggle_pause(): state["paused"] = not state["paused"]
-def toggle_mute(): state["muted"] = not state["muted"]
+class CommandQueue:
+    """
+    Ordered control commands between threads, under one Condition. put() coalesces with the newest
+    pending command of the same kind (seek/skip/speed offsets add up, two pause toggles cancel,
+    anything else keeps the latest argument) and wakes the consumer at once.
+    Items are (kind, arg, perf_counter of the first put), so consumers can report response time.
+    """
+    ADDITIVE = ("seek", "skip", "speed", "enqueue") # Enqueued path lists concatenate
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.items = deque()
+
+    def put(self, kind, arg=None):
+        with self.cond:
+            last = self.items[-1] if self.items else None
+            if last and last[0] == kind:
+                if kind in self.ADDITIVE:
+                    last[1] += arg
+                    if not last[1]: self.items.pop() # Net zero: nothing to do
+                elif kind == "pause": self.items.pop()
+                else: last[1] = arg
+            else:
+                self.items.append([kind, arg, time.perf_counter()])
+            self.cond.notify_all()
+
+    def pop(self):
+        """Next command, or None. Never blocks (cheap enough for the scheduler to call per wake-up)."""
+        if not self.items: return None
+        with self.cond:
+            return tuple(self.items.popleft()) if self.items else None
+
+    def get(self, timeout=None):
+        """Next command, blocking up to timeout (None = forever). None on timeout."""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.items, timeout): return None
+            return tuple(self.items.popleft())
+
+    def wait(self, timeout):
+        """Sleeps until a command is pending or timeout passes, without taking it."""
+        with self.cond:
+            return self.cond.wait_for(lambda: self.items, timeout)
+
+    def clear(self):
+        with self.cond: self.items.clear()
+
+COMMANDS = CommandQueue()    # To the player: pause, seek, skip, speed, mixer, play, enqueue, restart, stop
+UI_COMMANDS = CommandQueue() # To the console thread: menu, mixer (sent by the player once parked), stop
+
+def next_song(): COMMANDS.put("skip", 1)
+def prev_song(): COMMANDS.put("skip", -1)
+def toggle_pause(): COMMANDS.put("pause")
+def toggle_mute(): state["muted"] = not state["muted"]   # Plain flags: only hotkeys write them
 def toggle_loop(): state["looping"] = not state["looping"]
-def stop_script(): state["running"] = False; state["restart_flag"] = True
-def trigger_menu(): state["request_selection"] = True
-def trigger_mixer(): state["request_track_mixer"] = True
-def speed_up(): state["playback_speed"] = min(state["playback_speed"] + CONFIG["speed_step"], 10.0)
-def speed_down(): state["playback_speed"] = max(state["playback_speed"] - CONFIG["speed_step"], 0.1)
-def seek_forward(): state["seek_request"] = "forward"
-def seek_backward(): state["seek_request"] = "backward"
-def fine_seek_forward(): state["seek_request"] = "fine_forward"
-def fine_seek_backward(): state["seek_request"] = "fine_backward"
-
-keyboard.add_hotkey('right', next_song)
-keyboard.add_hotkey('left', prev_song)
-keyboard.add_hotkey('up', speed_up)
-keyboard.add_hotkey('down', speed_down)
-keyboard.add_hotkey('page down', seek_forward)
-keyboard.add_hotkey('page up', seek_backward)
-keyboard.add_hotkey('end', fine_seek_forward)
-keyboard.add_hotkey('home', fine_seek_backward)
-keyboard.add_hotkey('F3', toggle_pause)
-keyboard.add_hotkey('F4', stop_script)
-keyboard.add_hotkey('F5', trigger_menu)
-keyboard.add_hotkey('F6', toggle_mute)
-keyboard.add_hotkey('F7', trigger_mixer)
-keyboard.add_hotkey('F8', toggle_loop)
+def stop_script(): state["running"] = False; COMMANDS.put("stop"); UI_COMMANDS.put("stop")
+def trigger_menu(): UI_COMMANDS.put("menu")
+def trigger_mixer(): COMMANDS.put("mixer")
+def speed_up(): COMMANDS.put("speed", CONFIG["speed_step"])
+def speed_down(): COMMANDS.put("speed", -CONFIG["speed_step"])
+def seek_forward(): COMMANDS.put("seek", CONFIG["seek_step"])
+def seek_backward(): COMMANDS.put("seek", -CONFIG["seek_step"])
+def fine_seek_forward(): COMMANDS.put("seek", CONFIG["fine_seek_step"])
+def fine_seek_backward(): COMMANDS.put("seek", -CONFIG["fine_seek_step"])
+
+UI_SHOWN = threading.Event() # Set once the first menu (or the resumed dashboard) is on screen
+
+HOTKEYS = {
+    'right': next_song, 'left': prev_song, 'up': speed_up, 'down': speed_down,
+    'page down': seek_forward, 'page up': seek_backward, 'end': fine_seek_forward, 'home': fine_seek_backward,
+    'F3': toggle_pause, 'F4': stop_script, 'F5': trigger_menu, 'F6': toggle_mute, 'F7': trigger_mixer, 'F8': toggle_loop,
+}
+NAV_HOTKEYS = ('right', 'left', 'up', 'down') # Also the search picker's cursor keys: unhooked while it is open
+HOTKEY_STATE = {"registered": False, "handles": {}, "suspended": set()}
+HOTKEY_LOCK = threading.Lock()
+
+def register_hotkeys():
+    # Global hooks are a desktop concern: only loaded for the Windows backend
+    import keyboard
+    with HOTKEY_LOCK:
+        HOTKEY_STATE["registered"] = True
+        for key, callback in HOTKEYS.items():
+            if key not in HOTKEY_STATE["suspended"]: HOTKEY_STATE["handles"][key] = keyboard.add_hotkey(key, callback)
+
+def suspend_hotkeys(keys):
+    """Unhooks keys until resume_hotkeys (also if the hooks only get registered in between)."""
+    with HOTKEY_LOCK:
+        HOTKEY_STATE["suspended"].update(keys)
+        handles = [HOTKEY_STATE["handles"].pop(key) for key in keys if key in HOTKEY_STATE["handles"]]
+        if handles:
+            import keyboard
+            for handle in handles: keyboard.remove_hotkey(handle)
+
+def resume_hotkeys(keys):
+    with HOTKEY_LOCK:
+        HOTKEY_STATE["suspended"].difference_update(keys)
+        if not HOTKEY_STATE["registered"]: return
+        import keyboard
+        for key in keys:
+            if key not in HOTKEY_STATE["handles"]: HOTKEY_STATE["handles"][key] = keyboard.add_hotkey(key, HOTKEYS[key])
+
+def finish_startup():
+    """
+    Runs on its own thread once the first screen is up: creates the output backend (pywin32) and
+    installs the global hooks (keyboard), so neither import delays the menu.
+    """
+    UI_SHOWN.wait()
+    if get_output().interactive: register_hotkeys()
 
 # ============================================================================
 # 7. UI HELPERS
@@ -212,197 +600,1131 @@ def format_time(seconds):
     secs = int(seconds % 60)
     return f"{mins:02d}:{secs:02d}"
 
-def update_dashboard(current_sec, total_sec, is_seeking=False):
-    if total_sec == 0: total_sec = 1
-    percent = min(current_sec / total_sec, 1.0)
-    filled = int(35 * percent)
-    bar = "█" * filled + "░" * (35 - filled)
-    
-    if is_seeking: st = "⏩ SEEKING    "
-    elif state["paused"]: st = "⏸  PAUSED     "
-    elif state["muted"]: st = "🔇 MUTED      "
-    elif state["looping"]: st = "🔁 LOOPING    "
-    else: st = "▶  PLAYING    "
-    
-    state["dashboard"].update({
-        "st": st, "bar": bar, 
-        "curr": format_time(current_sec), "tot": format_time(total_sec), 
-        "spd": f"{state['playback_speed']:.1f}"
-    })
+def clear_screen():
+    """Clears the console with ANSI codes (no shell spawned)."""
+    sys.stdout.write("\033[H\033[J"); sys.stdout.flush()
+
+def enable_ansi():
+    """Turns on ANSI escape handling in the Windows console (a no-op elsewhere)."""
+    if os.name != "nt": return
+    try:
+        kernel32 = ctypes.windll.kernel32; handle = kernel32.GetStdHandle(-11); mode = ctypes.c_uint32()
+        if kernel32.GetConsoleMode(handle, ctypes.byref(mode)): kernel32.SetConsoleMode(handle, mode.value | 0x0004)
+    except Exception: pass
+
+CONTROLS_LINE = "⌨️  F3:Pause F4:Stop F5:Menu F6:Mute F7:Mixer F8:Loop | PgUp/Dn: Seek | Home/End: Fine Seek | Arrows: Nav"
+BAR_WIDTH = 35; BAR_CHARS = "█░"
+
+def format_mixer(d):
+    """Mixer line from the snapshot's raw mix / ensemble fields."""
+    if d["ensemble"]:
+        return f"Ensemble x{len(d['ensemble'])} | " + " | ".join(
+            f"W{n}: {'+'.join(map(str, tracks)) or '-'}{'' if live else ' (no window)'}" for n, tracks, live in d["ensemble"])
+    if not d["mix"]: return ""
+    source, indices, playable, msgs, saved, transpose, folded = d["mix"]
+    if source == "Auto": source = f"Auto (Trk {'+'.join(map(str, indices))})"
+    return (f"{source} | Active: {len(indices)} / {playable} Tracks | Keys: {msgs} msgs ({saved} saved)"
+            f" | Transpose: {transpose:+d} ({folded} folded)")
+
+def playback_position(d):
+    """Song position (s) from a dashboard snapshot and the clock, readable from any thread."""
+    clock = state["clock"]
+    if state["paused"] and d["paused_at"] is not None: return d["paused_at"]
+    if not clock: return 0.0
+    origin, origin_sec, speed = clock.base
+    return origin_sec + (time.perf_counter() - origin) * speed
+
+class Renderer:
+    """
+    Draws the now-playing screen on its own thread, every ui_refresh seconds, from a snapshot of
+    state["dashboard"] and the clock. A frame is a set of (row, col) -> text segments; only segments
+    that changed are written, from their first changed character (ANSI cursor moves, no subprocess).
+    Menus suspend() it while they own the console; resume() redraws from a clear screen.
+    """
+    def __init__(self, out=None):
+        self.out = out or sys.stdout
+        self.lock = threading.Lock()
+        self.active = False
+        self.prev = {}; self.width = 0; self.fresh = True
+        self.frames = 0; self.bytes = 0 # Written so far (for the bench / tests)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while state["running"]:
+            time.sleep(CONFIG["ui_refresh"])
+            with self.lock:
+                if self.active: self.draw()
 
-def print_dashboard():
-    d = state["dashboard"]
-    sys.stdout.write(f"\r{d['st']} | {d['bar']} | {d['curr']} / {d['tot']} | Spd: {d['spd']}x   ")
-    sys.stdout.flush()
+    def suspend(self):
+        with self.lock:
+            self.active = False
+            self.out.write("\033[?25h"); self.out.flush() # Menus take input: show the cursor
+
+    def resume(self):
+        with self.lock: self.active = True; self.fresh = True
+
+    def compose(self):
+        """Snapshot -> {(row, col): text}. Empty until a song is loaded."""
+        d = dict(state["dashboard"])
+        if not d["song"]: return {}
+        total = d["total"] or 1.0
+        position = min(max(playback_position(d), 0.0), total)
+        filled = int(BAR_WIDTH * position / total)
+
+        if state["paused"]: icon, status = "⏸", "PAUSED"
+        elif state["muted"]: icon, status = "🔇", "MUTED"
+        elif state["looping"]: icon, status = "🔁", "LOOPING"
+        else: icon, status = "▶", "PLAYING"
+        output = state["output"]
+        window = (f"{'found' if output.target else 'NOT FOUND'} ({output.resolve_attempts} lookups, {output.resolve_failures} failed)"
+                  if output else "-")
+        start = f"{d['start_ms']:.1f}ms {d['load_source']}" if d["start_ms"] is not None else ""
+        rule = "=" * 80
+        return {(1, 1): rule, (2, 1): f"🎵 NOW PLAYING: {os.path.basename(d['song'])}",
+                (3, 1): f"🎛️  Mixer: {format_mixer(d)}", (4, 1): f"🪟 Window: {window}", (5, 1): rule,
+                (7, 1): icon, (7, 4): f"{status:<8}", (7, 13): "█" * filled + "░" * (BAR_WIDTH - filled),
+                (7, 14 + BAR_WIDTH): f"| {format_time(position)} / {format_time(total)} | Spd: {state['playback_speed']:.1f}x",
+                (8, 4): f"Start: {start} | Thin/Delay: {d['thinned']}/{d['delayed']}{STATS.brief()}{ENSEMBLE.brief()}",
+                (10, 1): rule, (11, 1): CONTROLS_LINE, (12, 1): rule}
+
+    def draw(self):
+        """Writes what changed since the last frame (everything after resume or a terminal resize)."""
+        width = shutil.get_terminal_size().columns
+        frame = {pos: text[:max(0, width - pos[1])] for pos, text in self.compose().items()} # Never wrap a row
+        parts = []
+        if self.fresh or width != self.width:
+            self.prev = {}; self.width = width; self.fresh = False; parts.append("\033[?25l\033[H\033[J")
+        row_ends = {}
+        for row, col in frame: row_ends[row] = max(row_ends.get(row, 0), col)
+        for (row, col), text in frame.items():
+            old = self.prev.get((row, col), "")
+            if text == old: continue
+            p = 0; limit = min(len(text), len(old))
+            while p < limit and text[p] == old[p]: p += 1
+            prefix = text[:p]
+            if not (prefix.isascii() or not prefix.strip(BAR_CHARS)): p = 0 # Emoji width varies by terminal: redraw from col
+            tail = text[p:]
+            if len(text) < len(old): tail += "\033[K" if col == row_ends[row] else " " * (len(old) - len(text))
+            parts.append(f"\033[{row};{col + p}H{tail}")
+        for row, col in self.prev.keys() - frame.keys(): parts.append(f"\033[{row};{col}H\033[K")
+        self.prev = frame
+        if parts:
+            data = "".join(parts); self.out.write(data); self.out.flush()
+            self.frames += 1; self.bytes += len(data.encode("utf-8"))
 
 # ============================================================================
 # 8. FILE & TRACK LOGIC (REFACTORED)
 # ============================================================================
-def get_subfolders():
-    if not os.path.exists(CONFIG["midi_root"]): os.makedirs(CONFIG["midi_root"])
-    return sorted([d for d in os.listdir(CONFIG["midi_root"]) if os.path.isdir(os.path.join(CONFIG["midi_root"], d))])
-
-def scan_files(subfolder=None):
-    file_list = []
-    root_path = CONFIG["midi_root"]
-    if subfolder:
-        target_path = os.path.join(root_path, subfolder)
-        for f in os.listdir(target_path):
-            if f.lower().endswith(('.mid', '.midi')): file_list.append(os.path.join(target_path, f))
-    else:
-        for dirpath, _, filenames in os.walk(root_path):
-            for f in filenames:
-                if f.lower().endswith(('.mid', '.midi')): file_list.append(os.path.join(dirpath, f))
-    return sorted(file_list)
+def is_drum_track(note_count, drum_count):
+    """Drums when most of the track's note-ons are on channel 10 (9 zero-based), whatever program it sets first."""
+    return drum_count * 2 > note_count
 
 def get_track_info(mid):
     info = []
     for i, track in enumerate(mid.tracks):
-        note_count = sum(1 for m in track if m.type == 'note_on' and m.velocity > 0)
-        instrument = "Unknown"; is_drum = False
-        for msg in track:
-            if msg.type == 'program_change': 
-                instrument = GM_INSTRUMENTS.get(msg.program, f"Prog {msg.program}")
-                break
-            if msg.type == 'note_on' and msg.channel == 9: 
-                is_drum = True; instrument = "DRUMS (Ch10)"; break
-        if note_count > 0: info.append({'index': i, 'name': track.name.strip(), 'notes': note_count, 'inst': instrument, 'drum': is_drum})
+        notes = [m for m in track if m.type == 'note_on' and m.velocity > 0]
+        program = next((m.program for m in track if m.type == 'program_change'), None)
+        is_drum = is_drum_track(len(notes), sum(1 for m in notes if m.channel == 9))
+        if is_drum: instrument = "DRUMS (Ch10)"
+        elif program is not None: instrument = GM_INSTRUMENTS.get(program, f"Prog {program}")
+        else: instrument = "Unknown"
+        if notes: info.append({'index': i, 'name': track.name.strip(), 'notes': len(notes), 'inst': instrument, 'drum': is_drum})
     return info
 
-def prepare_midi_data(full_path, manual_indices=None):
+DEFAULT_TEMPO = 500000 # Microseconds per beat (120 BPM), the SMF default
+
+def build_tempo_map(tempo_events, ticks_per_beat):
     """
-    Refactored helper to parse MIDI, select tracks, and build the timeline.
-    Returns: (mido_obj, events_dict, total_duration_sec, active_tracks_count, total_playable_tracks, tempo)
+    Turns (abs_tick, tempo) events into constant-tempo segments with the
+    cumulative seconds at each segment start, for bisect-based lookups.
     """
+    ticks = [0]; tempos = [DEFAULT_TEMPO]; secs = [0.0] # Default 120 BPM until told otherwise
+    for tick, tempo in sorted(tempo_events, key=lambda e: e[0]):
+        if tick == ticks[-1]:
+            tempos[-1] = tempo # Later event on the same tick wins
+            continue
+        secs.append(secs[-1] + (tick - ticks[-1]) * tempos[-1] / (1e6 * ticks_per_beat))
+        ticks.append(tick); tempos.append(tempo)
+    return {"ticks": ticks, "tempos": tempos, "secs": secs, "tpb": ticks_per_beat}
+
+def tick_to_seconds(tempo_map, tick):
+    i = bisect.bisect_right(tempo_map["ticks"], tick) - 1
+    return tempo_map["secs"][i] + (tick - tempo_map["ticks"][i]) * tempo_map["tempos"][i] / (1e6 * tempo_map["tpb"])
+
+def ticks_to_seconds(tempo_map, ticks):
+    """Sorted ticks -> array('d') of seconds. Walks ticks and tempo segments together: O(n + segments)."""
+    seg = 0; secs = array('d'); last = len(tempo_map["ticks"]) - 1
+    for tick in ticks:
+        while seg < last and tempo_map["ticks"][seg + 1] <= tick: seg += 1
+        secs.append(tempo_map["secs"][seg] + (tick - tempo_map["ticks"][seg]) * tempo_map["tempos"][seg] / (1e6 * tempo_map["tpb"]))
+    return secs
+
+def seconds_to_tick(tempo_map, seconds):
+    i = max(bisect.bisect_right(tempo_map["secs"], seconds) - 1, 0)
+    return tempo_map["ticks"][i] + (seconds - tempo_map["secs"][i]) * 1e6 * tempo_map["tpb"] / tempo_map["tempos"][i]
+
+class LRUCache:
+    """Thread-safe LRU map that evicts by an approximate byte budget."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is None: return None
+            self.items.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            if key in self.items: self.used -= self.items.pop(key)[1]
+            self.items[key] = (value, size)
+            self.used += size
+            # Always keep the newest entry, even if it alone exceeds the budget
+            while self.used > self.max_bytes and len(self.items) > 1:
+                _, (_, old_size) = self.items.popitem(last=False)
+                self.used -= old_size
+
+SONG_CACHE = LRUCache(CONFIG["cache_max_mb"] * 1024 * 1024)
+
+# --- NOTE-ONLY SMF READER ---
+# Decodes MTrk chunks straight from an mmap, one pass per track, keeping only what playback uses:
+# note-on ticks/pitches, tempo changes, the first program, channel-10 note count and the track name.
+# Anything it does not fully understand returns None, and the file goes through mido instead.
+SMF_DATA_LEN = {0x80: 2, 0x90: 2, 0xA0: 2, 0xB0: 2, 0xC0: 1, 0xD0: 1, 0xE0: 2}
+
+def read_smf_track(buf, pos, end, tempo_events):
+    """One MTrk chunk -> (ticks, pitches, name, instrument, drum), appending set_tempo to tempo_events. None if malformed."""
+    ticks = array('q'); pitches = array('B'); add_tick = ticks.append; add_pitch = pitches.append
+    tick = 0; running = None; name = None; instrument = None; drum_notes = 0
+    while pos < end:
+        b = buf[pos]; pos += 1; delta = b & 0x7F
+        while b & 0x80: b = buf[pos]; pos += 1; delta = (delta << 7) | (b & 0x7F)
+        tick += delta
+
+        status = buf[pos]
+        if status & 0x80: pos += 1
+        elif running is None or running >= 0xF0: return None # No channel status to run on (mido errors, or re-reads sysex)
+        else: status = running # Running status: the byte just peeked is the first data byte
+
+        if status < 0xF0:
+            running = status; kind = status & 0xF0
+            if kind == 0x90:
+                note = buf[pos]; velocity = buf[pos + 1]; pos += 2
+                if (note | velocity) & 0x80: return None
+                if velocity:
+                    add_tick(tick); add_pitch(note)
+                    if status == 0x99: drum_notes += 1
+            elif SMF_DATA_LEN[kind] == 2:
+                if (buf[pos] | buf[pos + 1]) & 0x80: return None
+                pos += 2
+            else:
+                program = buf[pos]; pos += 1
+                if program & 0x80: return None
+                if kind == 0xC0 and instrument is None: instrument = GM_INSTRUMENTS.get(program, f"Prog {program}")
+        elif status == 0xFF: # Meta: does not touch running status
+            meta = buf[pos]; pos += 1
+            b = buf[pos]; pos += 1; length = b & 0x7F
+            while b & 0x80: b = buf[pos]; pos += 1; length = (length << 7) | (b & 0x7F)
+            if meta == 0x51:
+                if length < 3: return None
+                tempo_events.append((tick, (buf[pos] << 16) | (buf[pos + 1] << 8) | buf[pos + 2]))
+            elif meta == 0x03 and name is None:
+                name = bytes(buf[pos:pos + length]).decode("latin1") # mido's default meta charset
+            pos += length
+        elif status in (0xF0, 0xF7): # Sysex: skipped by length
+            running = status # mido lets sysex set running status; a data byte next sends the file to mido
+            b = buf[pos]; pos += 1; length = b & 0x7F
+            while b & 0x80: b = buf[pos]; pos += 1; length = (length << 7) | (b & 0x7F)
+            pos += length
+        else: # System common/realtime inside a file: leave it to mido
+            return None
+    if pos != end: return None # An event ran past the chunk
+    drum = is_drum_track(len(ticks), drum_notes)
+    return ticks, pitches, name or "", "DRUMS (Ch10)" if drum else instrument or "Unknown", drum
+
+def read_smf(full_path):
+    """Note-only parse with the same result as the mido path; None if the file needs mido (or is unreadable)."""
+    try:
+        with open(full_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            buf = memoryview(mm)
+            try: return decode_smf(buf)
+            finally: buf.release()
+    except (OSError, ValueError, IndexError, KeyError, struct.error, BufferError):
+        return None
+
+def decode_smf(buf):
+    magic, size = struct.unpack_from(">4sL", buf, 0)
+    if magic != b"MThd" or size < 6: return None
+    _, track_count, ticks_per_beat = struct.unpack_from(">hhh", buf, 8)
+    if ticks_per_beat <= 0: return None # SMPTE time division
+    pos = 8 + size; tempo_events = []; track_ticks = []; track_pitches = []; track_info = []
+    for i in range(track_count):
+        magic, size = struct.unpack_from(">4sL", buf, pos)
+        start = pos + 8; pos = start + size
+        if magic != b"MTrk" or pos > len(buf): return None
+        track = read_smf_track(buf, start, pos, tempo_events)
+        if track is None: return None
+        ticks, pitches, name, instrument, drum = track
+        track_ticks.append(ticks); track_pitches.append(pitches)
+        if ticks: track_info.append({'index': i, 'name': name.strip(), 'notes': len(ticks), 'inst': instrument, 'drum': drum})
+    return {
+        "ticks_per_beat": ticks_per_beat,
+        "tempo_map": build_tempo_map(tempo_events, ticks_per_beat),
+        "track_ticks": track_ticks, "track_pitches": track_pitches,
+        "track_info": track_info,
+    }
+
+def parse_song(full_path):
+    """Per-track note arrays, tempo map and track info: the note-only reader, else mido. None if unreadable."""
+    song = read_smf(full_path)
+    return song if song is not None else parse_song_mido(full_path)
+
+def parse_song_mido(full_path):
+    """Full mido parse (every message decoded); the fallback for files read_smf rejects."""
+    import mido # Only the fallback needs it: ~70 ms of import kept off startup
     try:
         mid = mido.MidiFile(full_path)
     except:
-        return None, None, 0, 0, 0, 500000
+        return None
 
-    # 1. Determine Tracks to Play
-    fname = os.path.basename(full_path)
-    indices = []
-    track_source_name = "Auto"
-    
+    # Absolute-tick note arrays per track, so a new mix only needs a re-merge
+    track_ticks = []; track_pitches = []
+    for track in mid.tracks:
+        curr_ticks = 0; ticks = array('q'); pitches = array('B')
+        for msg in track:
+            curr_ticks += msg.time
+            if msg.type == 'note_on' and msg.velocity > 0: ticks.append(curr_ticks); pitches.append(msg.note)
+        track_ticks.append(ticks); track_pitches.append(pitches)
+
+    # Tempo changes can live on any track (type 1 files usually keep them in track 0)
+    tempo_events = []
+    for track in mid.tracks:
+        curr_ticks = 0
+        for msg in track:
+            curr_ticks += msg.time
+            if msg.type == 'set_tempo': tempo_events.append((curr_ticks, msg.tempo))
+
+    return {
+        "ticks_per_beat": mid.ticks_per_beat,
+        "tempo_map": build_tempo_map(tempo_events, mid.ticks_per_beat),
+        "track_ticks": track_ticks, "track_pitches": track_pitches,
+        "track_info": get_track_info(mid),
+    }
+
+# --- ON-DISK COMPILED SONGS ---
+# <magic, version, meta_len> + JSON meta (tempo map, track info, array layout) + raw 8-byte aligned arrays
+CACHE_MAGIC = b"JKBX"
+CACHE_FORMAT_VERSION = 2 # 2: drum flag from the channel-10 note share
+CACHE_HEADER = struct.Struct("<4sII")
+
+def file_digest(full_path):
+    h = hashlib.sha1()
+    with open(full_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""): h.update(chunk)
+    return h.hexdigest()
+
+def compiled_song_path(digest):
+    return os.path.join(CONFIG["cache_dir"], f"{digest}.v{CACHE_FORMAT_VERSION}.jkc")
+
+def save_compiled_song(path, song):
+    layout = []; blobs = []; offset = 0
+    for ticks, pitches in zip(song["track_ticks"], song["track_pitches"]):
+        raw_ticks = ticks.tobytes(); raw_pitches = pitches.tobytes()
+        raw_pitches += b"\0" * (-len(raw_pitches) % 8)
+        layout.append([offset, offset + len(raw_ticks), len(ticks)])
+        blobs += [raw_ticks, raw_pitches]; offset += len(raw_ticks) + len(raw_pitches)
+    tmap = song["tempo_map"]
+    meta = json.dumps({
+        "byteorder": sys.byteorder, "ticks_per_beat": song["ticks_per_beat"],
+        "tempo_map": {k: tmap[k] for k in ("ticks", "tempos", "secs")},
+        "track_info": song["track_info"], "layout": layout,
+    }).encode("utf-8")
+    header = CACHE_HEADER.pack(CACHE_MAGIC, CACHE_FORMAT_VERSION, len(meta)) + meta
+    header += b"\0" * (-len(header) % 8)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        for blob in blobs: f.write(blob)
+    os.replace(tmp_path, path) # Atomic: readers see the old file or the new one, never half of it
+
+def load_compiled_song(path):
+    """Memory-maps a compiled song; the note arrays are zero-copy views. None on miss/mismatch."""
+    try:
+        with open(path, "rb") as f: mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        magic, version, meta_len = CACHE_HEADER.unpack_from(mm, 0)
+        if magic != CACHE_MAGIC or version != CACHE_FORMAT_VERSION: return None
+        meta = json.loads(mm[CACHE_HEADER.size:CACHE_HEADER.size + meta_len].decode("utf-8"))
+        if meta["byteorder"] != sys.byteorder: return None
+        base = CACHE_HEADER.size + meta_len; base += -base % 8
+        view = memoryview(mm)
+        track_ticks = []; track_pitches = []
+        for ticks_off, pitches_off, count in meta["layout"]:
+            track_ticks.append(view[base + ticks_off:base + ticks_off + 8 * count].cast('q'))
+            track_pitches.append(view[base + pitches_off:base + pitches_off + count].cast('B'))
+    except:
+        return None
+    tmap = meta["tempo_map"]; tmap["tpb"] = meta["ticks_per_beat"]
+    return {
+        "ticks_per_beat": meta["ticks_per_beat"], "tempo_map": tmap,
+        "track_ticks": track_ticks, "track_pitches": track_pitches,
+        "track_info": meta["track_info"],
+    }
+
+LOAD_INFO = threading.local() # .source of the calling thread's last load_song: memory | disk | parse
+
+def load_song(full_path):
+    """
+    Returns the song dict for a MIDI file, or None if it can't be read. Looks in memory
+    (path + mtime + size), then the on-disk compiled cache (content hash), then parses with mido.
+    """
+    try: st = os.stat(full_path)
+    except OSError: return None
+    key = ("song", full_path, st.st_mtime_ns, st.st_size)
+    song = SONG_CACHE.get(key)
+    if song:
+        LOAD_INFO.source = "memory"
+        return song
+
+    try: digest = file_digest(full_path) # Also keys the saved track selection, so needed with the disk cache off
+    except OSError: return None
+    song = None
+    if CONFIG["cache_dir"]:
+        try: song = load_compiled_song(compiled_song_path(digest))
+        except OSError: pass
+    if song:
+        LOAD_INFO.source = "disk"
+    else:
+        song = parse_song(full_path)
+        if not song: return None
+        LOAD_INFO.source = "parse"
+        if CONFIG["cache_dir"]:
+            try: save_compiled_song(compiled_song_path(digest), song)
+            except OSError: pass
+
+    song["key"] = key[1:]; song["digest"] = digest
+    # Rough footprint: 9 bytes per note in the arrays (0 if mmap'd, but count it anyway) + metadata
+    SONG_CACHE.put(key, song, 4096 + 9 * sum(len(t) for t in song["track_ticks"]))
+    return song
+
+def best_transpose(pitch_counts):
+    """Global shift (semitones) that puts the most notes inside NOTE_MAP; ties prefer octaves, then the smallest shift."""
+    if not CONFIG["auto_transpose"]: return 0
+    def score(shift):
+        return (sum(c for p, c in pitch_counts.items() if NOTE_LOW <= p + shift <= NOTE_HIGH), shift % 12 == 0, -abs(shift))
+    return max(range(-48, 49), key=score)
+
+def pitch_table(shift):
+    """
+    128-entry lookup baked at prepare time: MIDI note -> playable note after the global shift,
+    with leftovers folded by octaves into range (None = dropped, when auto_transpose is off).
+    """
+    table = []
+    for note in range(128):
+        p = note + shift
+        if CONFIG["auto_transpose"]:
+            while p < NOTE_LOW: p += 12
+            while p > NOTE_HIGH: p -= 12
+        table.append(p if p in NOTE_MAP else None)
+    return tuple(table)
+
+def build_timeline(song, indices, transpose=None):
+    """
+    Merges the selected tracks into parallel typed arrays: chord c is the unique tick times[c] at
+    secs[c], holding notes/tracks[chord_start[c]:chord_start[c+1]]. Cached per song + track selection.
+    transpose: global shift in semitones, None = pick the best one for the selected notes.
+    """
+    key = ("timeline",) + song["key"] + (tuple(indices), transpose, CONFIG["auto_transpose"],
+                                         CONFIG["note_hold_time"], CONFIG["chord_strum_delay"],
+                                         CONFIG["rate_limit_msgs"], CONFIG["rate_limit_window"])
+    timeline = SONG_CACHE.get(key)
+    if timeline: return timeline
+
+    # k-way merge of the already time-ordered tracks: each note is packed as tick << shift | rank, rank
+    # being its place in the selection-ordered concatenation, so the merge (heapq.merge) breaks tick
+    # ties by selection then track order and the rank gathers the notes back in merged order.
+    sel = [i for i in indices if i < len(song["track_ticks"])]
+    sizes = [len(song["track_ticks"][i]) for i in sel]
+    shift = max(sum(sizes), 1).bit_length(); mask = (1 << shift) - 1
+    offsets = itertools.accumulate(sizes, initial=0)
+    streams = [map(operator.or_, map(operator.lshift, song["track_ticks"][i], itertools.repeat(shift)), range(lo, lo + n))
+               for i, n, lo in zip(sel, sizes, offsets)]
+    ranks = list(map(operator.and_, heapq.merge(*streams), itertools.repeat(mask)))
+    all_ticks = array('q'); all_pitches = bytearray(); all_tracks = array('H') # Concatenated in selection order
+    for i, n in zip(sel, sizes):
+        all_ticks += song["track_ticks"][i]; all_pitches += song["track_pitches"][i]; all_tracks += array('H', [i]) * n
+    gather = operator.itemgetter(*ranks) if len(ranks) > 1 else lambda seq: [seq[r] for r in ranks] # One C call per array
+    note_ticks = gather(all_ticks); notes = array('B', bytes(gather(all_pitches))); tracks = array('H', gather(all_tracks))
+    del ranks, gather, all_ticks, all_pitches, all_tracks
+
+    # Chords: a new one wherever the merged tick changes
+    new_chord = [True]; new_chord += map(operator.ne, note_ticks[1:], note_ticks)
+    times = array('q', itertools.compress(note_ticks, new_chord))
+    chord_start = array('L', itertools.compress(range(len(notes)), new_chord)); chord_start.append(len(notes))
+    del note_ticks, new_chord
+
+    secs = ticks_to_seconds(song["tempo_map"], times)
+
+    if transpose is None: transpose = best_transpose(Counter(notes))
+    timeline = {"times": times, "secs": secs, "chord_start": chord_start, "notes": notes, "tracks": tracks,
+                "transpose": transpose, "key": key}
+    timeline["actions"] = compile_actions(timeline)
+    size = sum(a.itemsize * len(a) for a in (times, secs, chord_start, notes, tracks))
+    size += sum(a.itemsize * len(a) for a in timeline["actions"].values() if isinstance(a, array))
+    SONG_CACHE.put(key, timeline, 1024 + size)
+    return timeline
+
+def chord_cost(chord):
+    """Messages one chord posts: down + up per key, plus down + up per distinct modifier."""
+    return 2 * len(chord) + 2 * len({NOTE_MAP[n][0] for n in chord} - {None})
+
+def thin_chord(chord, budget):
+    """
+    Drops notes until the chord fits in budget messages. The top and bottom voices are kept;
+    inner octave doublings go first, then the inner notes nearest the middle. Keeps chord order.
+    """
+    if budget <= 0 or chord_cost(chord) <= budget: return chord
+    ranked = sorted(chord); inner = ranked[1:-1]; mid = (ranked[0] + ranked[-1]) / 2
+    doubled = lambda n: sum(1 for m in ranked if m % 12 == n % 12) > 1
+    drop_order = sorted(inner, key=lambda n: (not doubled(n), abs(n - mid)))
+    drop_order.append(ranked[0]) # Last resort: a lone melody note (top) beats a lone bass note
+    kept = list(chord)
+    for n in drop_order:
+        if chord_cost(kept) <= budget: break
+        kept.remove(n)
+    return kept
+
+def compile_actions(timeline):
+    """
+    Flattens the timeline into typed arrays of ready-to-post key messages.
+    Chord c plays records start[c]:start[c+1] at secs[c]; chords with no mapped notes are dropped,
+    so the tick loop only waits and emits. Notes go through the song's pitch_table first, duplicates
+    (e.g. two notes folded onto the same key) are merged, chords over the rate limit are thinned,
+    and the rest is grouped by modifier so each modifier is pressed once.
+    at[j] is record j's real-time offset from its chord (note_hold_time / chord_strum_delay),
+    which the tick loop turns into entries on its pending-release heap instead of sleeping.
+    """
+    hold = CONFIG["note_hold_time"]; strum = CONFIG["chord_strum_delay"]
+    ticks = array('q'); secs = array('d'); start = array('L', [0])
+    msgs = array('H'); wparams = array('H'); lparams = array('L'); flags = array('B'); at = array('d')
+    naive_count = 0; folded_count = 0; thinned_count = 0; group_cache = {}
+    budget = CONFIG["rate_limit_msgs"] if CONFIG["rate_limit_window"] > 0 else 0; chord_notes = array('H')
+    notes = timeline["notes"]; chord_start = timeline["chord_start"]
+    shift = timeline["transpose"]; table = pitch_table(shift)
+    for c, (tick, sec) in enumerate(zip(timeline["times"], timeline["secs"])):
+        chord = []
+        for k in range(chord_start[c], chord_start[c + 1]):
+            note = table[notes[k]]
+            if note is None: continue
+            if note != notes[k] + shift: folded_count += 1
+            naive_count += 4 if NOTE_MAP[note][0] else 2 # Posted per note without modifier grouping
+            if note not in chord: chord.append(note)
+        kept = thin_chord(chord, budget); thinned_count += len(chord) - len(kept)
+        groups = {}
+        for note in kept:
+            mod, key = NOTE_MAP[note]
+            groups.setdefault(mod, []).append(key)
+
+        onset = 0.0; mod_free = 0.0; key_free = {}
+        for mod in MODIFIER_ORDER:
+            if mod not in groups: continue
+            group_key = (mod, tuple(groups[mod]))
+            if group_key not in group_cache: group_cache[group_key] = group_actions(mod, group_key[1])
+            recs = group_cache[group_key]
+
+            # A group starts at the next strum slot, once its keys are released by an earlier group
+            # and (for modifier groups) once the previous modifier is back up: never shift+ctrl together.
+            group_start = max([onset] + [key_free.get(w, 0.0) for m, w, l, f in recs if f & ACT_STRUM])
+            if mod: group_start = max(group_start, mod_free)
+            t = group_start; down_at = {}
+            for msg, w, l, f in recs:
+                if f & ACT_STRUM: offset = down_at[w] = t; t += strum  # key down
+                elif msg == WM_KEYDOWN: offset = group_start              # modifier down
+                elif w in down_at: offset = key_free[w] = down_at[w] + hold # key up
+                else: offset = mod_free = max(down_at.values()) + hold      # modifier up
+                msgs.append(msg); wparams.append(w); lparams.append(l); flags.append(f); at.append(offset)
+            onset = t
+        if len(msgs) > start[-1]:
+            ticks.append(tick); secs.append(sec); start.append(len(msgs)); chord_notes.append(len(kept))
+    return {"ticks": ticks, "secs": secs, "start": start, "notes": chord_notes,
+            "msg": msgs, "wparam": wparams, "lparam": lparams, "flags": flags, "at": at,
+            "naive_count": naive_count, "saved_count": naive_count - len(msgs),
+            "folded_count": folded_count, "thinned_count": thinned_count}
+
+# --- AUTO-MIX ---
+def track_features(song):
+    """
+    Per-track features for the auto-mix, one dict per entry of song["track_info"]. Notes are taken
+    as they will play: after the song's best global shift, folded by octaves (see pitch_table).
+    in_range (share of notes inside NOTE_MAP with the shift alone, i.e. unfolded), polyphony (notes
+    per onset), density (onsets/s while the track plays), pitch_classes (share of the 12 covered),
+    overlap (share of onsets another track also hits), plus the set of playable (tick, note) pairs
+    and playable notes per 1 s bin.
+    """
+    tmap = song["tempo_map"]; feats = []
+    pitch_counts = Counter()
+    for t in song["track_info"]:
+        if not t['drum']: pitch_counts.update(song["track_pitches"][t['index']])
+    shift = best_transpose(pitch_counts); table = pitch_table(shift)
+    onset_sets = [set(song["track_ticks"][t['index']]) for t in song["track_info"]]
+    shared = set(); seen = set()
+    for onsets in onset_sets:
+        shared |= seen & onsets; seen |= onsets
+    for t, onsets in zip(song["track_info"], onset_sets):
+        ticks = song["track_ticks"][t['index']]; pitches = song["track_pitches"][t['index']]
+        mapped = [table[p] for p in pitches]
+        mask = [p is not None for p in mapped]
+        in_ticks = list(itertools.compress(ticks, mask)); in_pitches = list(itertools.compress(mapped, mask))
+        unfolded = sum(1 for p in pitches if NOTE_LOW <= p + shift <= NOTE_HIGH)
+        playable = {tick << 7 | p for tick, p in zip(in_ticks, in_pitches)} # (tick, note) packed into one int
+        # Per-second counts by bisecting the (already sorted) ticks at each whole-second boundary
+        end = int(tick_to_seconds(tmap, in_ticks[-1])) + 1 if in_ticks else 0
+        edges = [bisect.bisect_left(in_ticks, seconds_to_tick(tmap, sec)) for sec in range(end + 1)]
+        bins = {sec: hi - lo for sec, (lo, hi) in enumerate(zip(edges, edges[1:])) if hi > lo}
+        span = tick_to_seconds(tmap, ticks[-1]) - tick_to_seconds(tmap, ticks[0]) if len(ticks) else 0.0
+        feats.append({
+            "index": t['index'], "drum": t['drum'],
+            "in_range": unfolded / len(ticks) if len(ticks) else 0.0,
+            "polyphony": len(ticks) / len(onsets) if onsets else 0.0,
+            "density": len(onsets) / max(span, 1.0),
+            "pitch_classes": len({p % 12 for p in in_pitches}) / 12,
+            "overlap": len(onsets & shared) / len(onsets) if onsets else 0.0,
+            "playable": playable, "bins": bins,
+        })
+    return feats
+
+def auto_mix(song, feats=None):
+    """
+    Greedy track-subset search: repeatedly add the melodic track that contributes the most new
+    playable (tick, note) pairs, weighted by its in-range share (mostly-clipped tracks sound broken),
+    while the busiest second of the mix stays within mix_keys_per_sec. Gains only shrink as the
+    mix grows, so stale heap scores are upper bounds and most candidates are never re-scored.
+    Returns the chosen track indices, lead first ([] if nothing is playable).
+    """
+    if feats is None: feats = track_features(song)
+    cands = [f for f in feats if not f["drum"] and f["playable"]]
+    budget = CONFIG["mix_keys_per_sec"]
+    heap = [(-len(f["playable"]) * f["in_range"], n) for n, f in enumerate(cands)]
+    heapq.heapify(heap)
+    covered = set(); load = {}; chosen = []; lead_gain = None
+    while heap:
+        _, n = heapq.heappop(heap); f = cands[n]
+        gain = len(f["playable"] - covered) * f["in_range"]
+        if heap and gain < -heap[0][0]:
+            heapq.heappush(heap, (-gain, n)); continue # Stale score; another track may be better now
+        if lead_gain is not None and gain < lead_gain * CONFIG["mix_min_gain"]: break
+        if chosen and any(load.get(b, 0) + c > budget for b, c in f["bins"].items()): continue
+        chosen.append(f["index"]); covered |= f["playable"]
+        for b, c in f["bins"].items(): load[b] = load.get(b, 0) + c
+        if lead_gain is None: lead_gain = gain # The lead is taken even if it alone is over budget
+    return chosen
+
+def busiest_track(song):
+    """Mix of last resort: the track with the most notes (drums last). Never a fixed index: track 0 is often the conductor."""
+    if not song["track_info"]: return [0] # No notes anywhere: nothing will play either way
+    return [max(song["track_info"], key=lambda t: (not t['drum'], t['notes']))['index']]
+
+def resolve_track_selection(full_path, song, manual_indices=None):
+    """
+    Which tracks to play: manual mixer choice > saved mix > auto-mix.
+    Returns: (indices, source_name, saved_speed or None, saved_transpose or None).
+    A manual choice always re-picks the transposition. Reads state only, so it is safe off-thread.
+    """
     if manual_indices:
-        indices = manual_indices
-        track_source_name = "Manual"
-    elif fname in state["track_db"]:
-        data = state["track_db"][fname]
-        if isinstance(data, dict):
-            indices = data.get("tracks", [])
-            # Update speed if saved
-            if "speed" in data: state["playback_speed"] = data["speed"]
-            track_source_name = "Saved Mix"
-        elif isinstance(data, list):
-            indices = data
-            track_source_name = "Saved Mix"
-    
-    # Fallback: Auto-select busiest track if no indices found
-    if not indices:
-        best = 0; maxn = 0
-        for i, t in enumerate(mid.tracks):
-            c = sum(1 for m in t if m.type == 'note_on' and m.velocity > 0)
-            if c > maxn: maxn, best = c, i
-        indices = [best]
-        track_source_name = f"Auto (Trk {best})"
-
-    # 2. Build Event Dictionary (Absolute Ticks -> Notes)
-    events_by_time = {}
-    total_playable_tracks = sum(1 for t in mid.tracks if sum(1 for m in t if m.type == 'note_on' and m.velocity > 0) > 0)
+        return manual_indices, "Manual", None, None
+    saved = get_selection(song, full_path)
+    saved_speed = saved.get("speed"); saved_transpose = saved.get("transpose")
+    if saved.get("tracks"): return saved["tracks"], "Saved Mix", saved_speed, saved_transpose
     
-    for i in indices:
-        if i < len(mid.tracks):
-            track = mid.tracks[i]
-            curr_ticks = 0
-            for msg in track:
-                curr_ticks += msg.time
-                if msg.type == 'note_on' and msg.velocity > 0:
-                    if curr_ticks not in events_by_time: events_by_time[curr_ticks] = []
-                    events_by_time[curr_ticks].append(msg.note)
+    # Fallback: auto-mix, computed once per loaded song
+    if "auto_mix" not in song: song["auto_mix"] = auto_mix(song) or busiest_track(song)
+    mix = song["auto_mix"]
+    return mix, "Auto", saved_speed, saved_transpose
 
-    # 3. Calculate Meta Data
-    sorted_times = sorted(events_by_time.keys())
-    last_tick = sorted_times[-1] if sorted_times else 0
-    tempo = mido.bpm2tempo(120) # Default
-    
-    # Scan for tempo changes (simplified: takes last tempo found in track 0)
-    for msg in mid.tracks[0]:
-        if msg.type == 'set_tempo': tempo = msg.tempo
+def split_tracks(song, indices, count):
+    """Deals a mix out to count windows: busiest track first, each to the part with the fewest notes so far."""
+    notes = {t["index"]: t["notes"] for t in song["track_info"]}
+    load = [0] * count; parts = [[] for _ in range(count)]
+    for idx in sorted(indices, key=lambda i: -notes.get(i, 0)):
+        p = load.index(min(load)); parts[p].append(idx); load[p] += notes.get(idx, 0)
+    return [sorted(part) for part in parts]
+
+def resolve_ensemble_parts(full_path, song, indices, count):
+    """Track subset per window: the mixer's saved assignment if it has count parts, else the mix split evenly."""
+    saved = get_selection(song, full_path).get("parts")
+    if saved and len(saved) == count: return saved
+    return split_tracks(song, indices, count)
+
+def prepare_midi_data(full_path, manual_indices=None):
+    """
+    Helper to load the (cached) song, select tracks, and build the (cached) timeline.
+    Returns: (song, timeline, total_duration_sec, active_tracks_count, total_playable_tracks, tempo_map)
+    """
+    song = load_song(full_path)
+    if not song:
+        return None, None, 0, 0, 0, None
 
-    total_duration = mido.tick2second(last_tick, mid.ticks_per_beat, tempo)
+    # 1. Determine Tracks to Play (+ saved speed)
+    indices, track_source_name, saved_speed, saved_transpose = resolve_track_selection(full_path, song, manual_indices)
+    if saved_speed: state["playback_speed"] = saved_speed
+
+    # 2. Build (or reuse) the timeline: Absolute Ticks -> Notes (+ transposition lookup table)
+    timeline = build_timeline(song, indices, saved_transpose)
+    total_playable_tracks = len(song["track_info"])
+
+    # 3. Calculate Meta Data
+    total_duration = timeline["secs"][-1] if timeline["secs"] else 0.0
     
-    state["dashboard"]["mixer"] = f"{track_source_name} | Active: {len(indices)} / {total_playable_tracks} Tracks"
+    actions = timeline["actions"]; dash = state["dashboard"]
+    dash["mix"] = (track_source_name, indices, total_playable_tracks, len(actions["msg"]), actions["saved_count"],
+                   timeline["transpose"], actions["folded_count"])
+    dash["total"] = total_duration; dash["ensemble"] = None
     
-    return mid, events_by_time, total_duration, len(indices), total_playable_tracks, tempo
+    return song, timeline, total_duration, len(indices), total_playable_tracks, song["tempo_map"]
 
 # ============================================================================
-# 9. MENUS
+# 9. LIBRARY INDEX
+# ============================================================================
+LIBRARY_SCHEMA_VERSION = 3 # 3: analyses redone with the channel-10 drum flag
+LIBRARY_LOCAL = threading.local()
+LIBRARY_REFRESH_LOCK = threading.Lock() # The rescan: menus wait on it only while the index is still empty
+LIBRARY_FILL_LOCK = threading.Lock()    # The metadata pass, which can take minutes on a big library
+
+def library_db():
+    """Per-thread connection to the library index. The index is a cache: a schema change rebuilds it."""
+    con = getattr(LIBRARY_LOCAL, "con", None)
+    if con is None:
+        con = sqlite3.connect(CONFIG["library_db"], timeout=10)
+        con.execute("PRAGMA journal_mode=WAL")
+        if con.execute("PRAGMA user_version").fetchone()[0] != LIBRARY_SCHEMA_VERSION:
+            con.executescript(f"""
+                DROP TABLE IF EXISTS dirs; DROP TABLE IF EXISTS files;
+                CREATE TABLE dirs (path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER);
+                CREATE TABLE files (
+                    path TEXT PRIMARY KEY, dir TEXT NOT NULL, size INTEGER, mtime_ns INTEGER,
+                    analysed INTEGER DEFAULT 0, duration REAL, playable_tracks INTEGER,
+                    busiest_track INTEGER, instruments TEXT, analysis TEXT);
+                CREATE INDEX files_dir ON files(dir);
+                PRAGMA user_version = {LIBRARY_SCHEMA_VERSION};""")
+        LIBRARY_LOCAL.con = con
+    return con
+
+def is_midi_file(name):
+    return name.lower().endswith(('.mid', '.midi'))
+
+def rescan_library():
+    """
+    Incrementally syncs the index with midi_root. Only directories whose mtime changed are re-listed;
+    known files are re-stat'd and queued for re-analysis when their size/mtime signature differs.
+    Returns the number of files added or changed.
+    """
+    con = library_db(); root = CONFIG["midi_root"]
+    if not os.path.exists(root): os.makedirs(root)
+    known_dirs = {}; children = {}
+    for path, parent, mtime_ns in con.execute("SELECT path, parent, mtime_ns FROM dirs"):
+        known_dirs[path] = mtime_ns; children.setdefault(parent, []).append(path)
+
+    seen_dirs = set(); changed = 0; stack = [root]
+    with con:
+        while stack:
+            d = stack.pop()
+            try: dir_mtime = os.stat(d).st_mtime_ns
+            except OSError: continue
+            seen_dirs.add(d)
+            known_files = {p: (size, m) for p, size, m in con.execute("SELECT path, size, mtime_ns FROM files WHERE dir = ?", (d,))}
+
+            if known_dirs.get(d) == dir_mtime:
+                # Same listing as last time: just check the files' stat signatures
+                stack.extend(children.get(d, []))
+                current = {}
+                for path in known_files:
+                    try: st = os.stat(path); current[path] = (st.st_size, st.st_mtime_ns)
+                    except OSError: pass
+            else:
+                current = {}
+                with os.scandir(d) as entries:
+                    for e in entries:
+                        if e.is_dir(): stack.append(e.path)
+                        elif is_midi_file(e.name) and e.is_file():
+                            st = e.stat(); current[e.path] = (st.st_size, st.st_mtime_ns)
+                con.execute("INSERT OR REPLACE INTO dirs (path, parent, mtime_ns) VALUES (?, ?, ?)",
+                            (d, None if d == root else os.path.dirname(d), dir_mtime))
+
+            for path in known_files.keys() - current.keys():
+                con.execute("DELETE FROM files WHERE path = ?", (path,))
+            for path, sig in current.items():
+                if known_files.get(path) == sig: continue
+                con.execute("INSERT OR REPLACE INTO files (path, dir, size, mtime_ns, analysed) VALUES (?, ?, ?, ?, 0)",
+                            (path, d) + sig)
+                changed += 1
+
+        for d in known_dirs.keys() - seen_dirs:
+            con.execute("DELETE FROM dirs WHERE path = ?", (d,))
+            con.execute("DELETE FROM files WHERE dir = ?", (d,))
+    return changed
+
+def analyse_song(song):
+    """Whole-file statistics: tempo map, per-track notes/instruments, range coverage, density, suggested mix."""
+    info = song["track_info"]; tmap = song["tempo_map"]
+    total_notes = 0; out_of_range = 0; all_ticks = []
+    for ticks, pitches in zip(song["track_ticks"], song["track_pitches"]):
+        total_notes += len(pitches)
+        out_of_range += sum(1 for p in pitches if p < NOTE_LOW or p > NOTE_HIGH)
+        all_ticks.extend(ticks)
+    all_ticks.sort()
+
+    # Peak chord = most onsets on one tick; peak rate = most onsets inside any 1 s window
+    peak_chord = 0; run = 0; prev = None
+    for tick in all_ticks:
+        run = run + 1 if tick == prev else 1; prev = tick
+        if run > peak_chord: peak_chord = run
+    secs = [tick_to_seconds(tmap, t) for t in all_ticks]
+    peak_rate = 0; lo = 0
+    for hi in range(len(secs)):
+        while secs[hi] - secs[lo] >= 1.0: lo += 1
+        if hi - lo + 1 > peak_rate: peak_rate = hi - lo + 1
+
+    feats = track_features(song)
+    mix = auto_mix(song, feats)
+    return {
+        "duration": secs[-1] if secs else 0.0,
+        "ticks_per_beat": song["ticks_per_beat"],
+        "tempo_map": [[tick, round(6e7 / tempo, 3)] for tick, tempo in zip(tmap["ticks"], tmap["tempos"])],
+        "tracks": [{"index": t['index'], "name": t['name'], "notes": t['notes'], "inst": t['inst'], "drum": t['drum'],
+                    **{k: round(f[k], 3) for k in ("in_range", "polyphony", "density", "pitch_classes", "overlap")}}
+                   for t, f in zip(info, feats)],
+        "total_notes": total_notes,
+        "out_of_range_share": out_of_range / total_notes if total_notes else 0.0,
+        "peak_chord": peak_chord,
+        "peak_notes_per_sec": peak_rate,
+        "suggested_mix": mix,
+    }
+
+def analyse_file(path):
+    """Worker-pool job (runs in a child process). Returns (path, analysis dict or None if unreadable)."""
+    song = load_song(path)
+    if not song: return path, None
+    return path, analyse_song(song)
+
+def init_pool_worker(config):
+    CONFIG.update(config) # Spawned children re-import the module; carry over runtime config
+
+def fill_library_metadata(progress=None, workers=None):
+    """
+    Analyses every new/changed file on a process pool, committing as it goes, so an interrupted
+    run resumes where it stopped. progress(done, total) is called per file. Returns files processed.
+    workers defaults to CONFIG["library_workers"] so a refresh behind the menu stays off the other cores.
+    """
+    con = library_db()
+    pending = [p for (p,) in con.execute("SELECT path FROM files WHERE analysed = 0")]
+    if not pending: return 0
+    from concurrent.futures import ProcessPoolExecutor
+    pool = ProcessPoolExecutor(max_workers=workers or CONFIG["library_workers"], initializer=init_pool_worker, initargs=(dict(CONFIG),))
+    done = 0
+    try:
+        for path, meta in pool.map(analyse_file, pending, chunksize=8):
+            if meta is None:
+                con.execute("UPDATE files SET analysed = -1 WHERE path = ?", (path,)) # Unreadable: don't retry
+            else:
+                con.execute("UPDATE files SET analysed = 1, duration = ?, playable_tracks = ?, busiest_track = ?, instruments = ?, analysis = ? WHERE path = ?",
+                            (meta["duration"], len(meta["tracks"]), meta["suggested_mix"][0] if meta["suggested_mix"] else None,
+                             json.dumps(sorted({t['inst'] for t in meta["tracks"]})), json.dumps(meta), path))
+            done += 1
+            if done % 64 == 0: con.commit()
+            if progress: progress(done, len(pending))
+    finally:
+        con.commit()
+        pool.shutdown(wait=False, cancel_futures=True)
+    return done
+
+def refresh_library():
+    """
+    Rescan, then metadata fill, each one at a time and skipped if already running. The listing lock
+    is released before the fill, so a first menu on an empty index waits for the scan only.
+    """
+    if not LIBRARY_REFRESH_LOCK.acquire(blocking=False): return
+    try:
+        rescan_library()
+        sync_search_index() # Before the slow metadata pass, so new files are searchable at once
+    except Exception:
+        return # The index is best effort; menus keep showing what it already has
+    finally:
+        LIBRARY_REFRESH_LOCK.release()
+    if not LIBRARY_FILL_LOCK.acquire(blocking=False): return # The running fill loops until nothing is pending
+    try:
+        while fill_library_metadata(): pass # Picks up rows a concurrent rescan added meanwhile
+    except Exception: pass
+    finally: LIBRARY_FILL_LOCK.release()
+
+def refresh_library_async():
+    threading.Thread(target=refresh_library, daemon=True).start()
+
+def ensure_library():
+    # First run (empty index): the listing must exist before a menu can show it; metadata can follow later
+    if not library_db().execute("SELECT 1 FROM dirs LIMIT 1").fetchone():
+        with LIBRARY_REFRESH_LOCK: rescan_library()
+
+def get_subfolders():
+    ensure_library()
+    rows = library_db().execute("SELECT path FROM dirs WHERE parent = ?", (CONFIG["midi_root"],))
+    return sorted(os.path.basename(p) for (p,) in rows)
+
+def scan_files(subfolder=None):
+    ensure_library()
+    if subfolder:
+        rows = library_db().execute("SELECT path FROM files WHERE dir = ?", (os.path.join(CONFIG["midi_root"], subfolder),))
+    else:
+        rows = library_db().execute("SELECT path FROM files")
+    return sorted(p for (p,) in rows)
+
+def get_library_metadata():
+    """path -> (duration, playable_tracks) for analysed files."""
+    rows = library_db().execute("SELECT path, duration, playable_tracks FROM files WHERE analysed = 1")
+    return {p: (d, n) for p, d, n in rows}
+
+# --- SEARCH ---
+SEARCH_WORDS = re.compile(r"[\W_]+")
+
+def search_key(text):
+    """NFKC + casefold: full-width letters and digits fold to ASCII, case is ignored, CJK stays as is."""
+    return " ".join(w for w in SEARCH_WORDS.split(unicodedata.normalize("NFKC", text).casefold()) if w)
+
+def trigrams(key):
+    """Trigrams of each word of a search_key, padded at the start ("  a", " ab") so word starts weigh more."""
+    grams = set()
+    for word in key.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+class SearchIndex:
+    """
+    In-memory trigram index over file names and their folders (relative to midi_root), kept in step
+    with the library index by sync(). Entries live in parallel lists (ids are reused after removals);
+    postings map each trigram to a set of ids.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = {}; self.paths = []; self.names = []; self.folders = []; self.hays = []; self.free = []; self.postings = {}
+        self.by_length = [] # Live ids, shortest name first: short queries scan in this order and stop early
+
+    def sync(self, paths):
+        """Adds new paths and drops missing ones (a set difference, so a refresh only touches what changed)."""
+        paths = set(paths); root = CONFIG["midi_root"]
+        with self.lock:
+            for path in self.ids.keys() - paths:
+                idx = self.ids.pop(path)
+                for gram in trigrams(self.names[idx]) | trigrams(self.folders[idx]): self.postings[gram].discard(idx)
+                self.paths[idx] = self.names[idx] = self.folders[idx] = self.hays[idx] = None; self.free.append(idx)
+            for path in paths - self.ids.keys():
+                rel = os.path.relpath(path, root)
+                name = search_key(os.path.splitext(os.path.basename(rel))[0]); folder = search_key(os.path.dirname(rel))
+                if self.free: idx = self.free.pop()
+                else: idx = len(self.paths); self.paths.append(None); self.names.append(None); self.folders.append(None); self.hays.append(None)
+                self.paths[idx] = path; self.names[idx] = name; self.folders[idx] = folder; self.ids[path] = idx
+                self.hays[idx] = f"{name}/{folder}" # Name and folder in one string for word checks
+                for gram in trigrams(name) | trigrams(folder): self.postings.setdefault(gram, set()).add(idx)
+            self.by_length = sorted(self.ids.values(), key=lambda idx: len(self.names[idx]))
+
+    def search(self, query, limit=50):
+        """
+        Best matches first, in tiers: name starts with the query > name contains it > every word is in
+        the name or folder > fuzzy (at least half the query's trigrams, so typos still match). Within a
+        tier: more shared trigrams, then shorter names. Tiers are only ranked until limit is filled.
+        Queries under 3 characters (e.g. a 2-character CJK name) have too few trigrams: substring scan.
+        """
+        q = search_key(query)
+        if not q: return []
+        with self.lock:
+            names = self.names; hays = self.hays
+            if len(q) < 3: # Already in length order: prefixes, then the first matches, no ranking needed
+                found = [idx for idx in self.by_length if names[idx].startswith(q)][:limit]
+                taken = set(found)
+                found += itertools.islice((idx for idx in self.by_length if idx not in taken and q in hays[idx]), limit - len(found))
+                return [self.paths[idx] for idx in found]
+
+            # Trigrams in over half the library (a shared folder name, say) barely rank anything but cost
+            # the most to count: leave them out, like stop words, unless that leaves nothing
+            postings = [self.postings.get(gram, ()) for gram in trigrams(q)]
+            postings = [ids for ids in postings if len(ids) <= len(self.ids) // 2] or postings
+            counts = Counter()
+            for ids in postings: counts.update(ids)
+            need = (len(postings) + 1) // 2
+            candidates = [idx for idx, n in counts.items() if n >= need]
+            key = lambda idx: (-counts[idx], len(names[idx]))
+
+            results = []; taken = set()
+            def take(tier):
+                best = heapq.nsmallest(limit - len(results), [idx for idx in tier if idx not in taken], key=key)
+                results.extend(best); taken.update(best)
+            take([idx for idx in candidates if names[idx].startswith(q)])
+            if len(results) < limit: take([idx for idx in candidates if q in names[idx]])
+            if len(results) < limit:
+                every = candidates
+                for w in q.split(): every = [idx for idx in every if w in hays[idx]]
+                take(every)
+            if len(results) < limit: take(candidates)
+            return [self.paths[idx] for idx in results]
+
+SEARCH_INDEX = SearchIndex()
+
+def sync_search_index():
+    SEARCH_INDEX.sync(p for (p,) in library_db().execute("SELECT path FROM files"))
+
+# ============================================================================
+# 10. MENUS
 # ============================================================================
 def run_track_mixer(full_path):
-    # --- HANDSHAKE: Wait for Player to Pause & Save State ---
-    # This prevents the UI from appearing before the resume_from_tick is saved.
-    state["player_ready_for_mixer"].wait(timeout=2.0)
-    state["player_ready_for_mixer"].clear()
+    # Sent by the player once it has parked and saved its position; always answer with "restart"
+    song = load_song(full_path)
+    if not song:
+        COMMANDS.put("restart", (full_path, None)); return
     
-    try: mid = mido.MidiFile(full_path)
-    except: return
-    
-    tracks = get_track_info(mid)
+    tracks = song["track_info"]
     fname = os.path.basename(full_path)
     
     # Load selection
-    selected = set()
+    saved = get_selection(song, full_path)
     if state["manual_track_indices"]:
         selected = set(state["manual_track_indices"])
-    elif fname in state["track_db"]:
-        data = state["track_db"][fname]
-        if isinstance(data, list): selected = set(data)
-        elif isinstance(data, dict): selected = set(data.get("tracks", []))
+    elif saved.get("tracks"):
+        selected = set(saved["tracks"])
     else:
-        best = max(tracks, key=lambda t: t['notes'])['index']
-        selected = {best}
+        if "auto_mix" not in song: song["auto_mix"] = auto_mix(song) or busiest_track(song)
+        selected = set(song["auto_mix"])
+
+    # Ensemble: tracks are toggled per window (part); the song plays the union
+    count = CONFIG["ensemble_parts"] if CONFIG["ensemble_parts"] > 1 else 0
+    parts = [set(p) for p in resolve_ensemble_parts(full_path, song, sorted(selected), count)] if count else []
+    if count: selected = set().union(*parts)
+    part = 0
 
     while True:
-        os.system('cls' if os.name == 'nt' else 'clear')
+        clear_screen()
         print("="*70); print(f"🎛️  TRACK MIXER: {fname}"); print("="*70)
-        print("Toggle tracks by number. Press ENTER to Resume."); print("-" * 70)
-        print(f"{'#':<4} {'[x]':<5} {'NOTES':<8} {'INSTRUMENT':<25} {'NAME'}")
+        if count: print(f"Editing window W{part + 1} of {count} (w1..w{count} to switch). Toggle tracks by number. Press ENTER to Resume.")
+        else: print("Toggle tracks by number. Press ENTER to Resume.")
+        print("-" * 70)
+        print(f"{'#':<4} {'[x]' if not count else 'WINDOWS':<{5 if not count else 12}} {'NOTES':<8} {'INSTRUMENT':<25} {'NAME'}")
         for t in tracks:
-            chk = "[x]" if t['index'] in selected else "[ ]"; warn = "⚠️" if t['drum'] else ""
-            print(f"{t['index']:<4} {chk:<5} {t['notes']:<8} {t['inst']:<25} {t['name']} {warn}")
+            warn = "⚠️" if t['drum'] else ""
+            if count: chk = f"{','.join(f'W{p + 1}' for p in range(count) if t['index'] in parts[p]) or '-':<12}"
+            else: chk = f"{'[x]' if t['index'] in selected else '[ ]':<5}"
+            print(f"{t['index']:<4} {chk} {t['notes']:<8} {t['inst']:<25} {t['name']} {warn}")
         print("-" * 70)
-        inp = input("Toggle # > ")
+        inp = input("Toggle # > ").strip().lower()
         if inp == "": break
+        if count and inp.startswith("w"):
+            if inp[1:].isdigit() and 1 <= int(inp[1:]) <= count: part = int(inp[1:]) - 1
+            continue
         try:
             idx = int(inp)
             if any(t['index'] == idx for t in tracks):
-                if idx in selected: selected.remove(idx)
+                if count:
+                    parts[part] ^= {idx}
+                    selected = set().union(*parts)
+                elif idx in selected: selected.remove(idx)
                 else: selected.add(idx)
         except: pass
     
-    # Save Data
-    if fname not in state["track_db"] or isinstance(state["track_db"][fname], list):
-        state["track_db"][fname] = {}
-    
-    state["track_db"][fname]["tracks"] = list(selected)
-    if "speed" not in state["track_db"][fname]:
-        state["track_db"][fname]["speed"] = state["playback_speed"]
-        
-    save_track_db()
-    state["manual_track_indices"] = list(selected)
-    state["restart_flag"] = True 
-    # SYNC: Tell playback thread we are done
-    state["mixer_ready_event"].set()
+    # Save Data (queued: written by the store's thread)
+    fields = {"parts": [sorted(p) for p in parts]} if count else {}
+    save_selection(song, full_path, tracks=sorted(selected), transpose=build_timeline(song, list(selected))["transpose"],
+                   speed=saved.get("speed") or state["playback_speed"], **fields)
+    COMMANDS.put("restart", (full_path, list(selected)))
+
+def print_search_results(query, results, meta, cursor=None, took_ms=0.0):
+    clear_screen() # Cheap enough to redraw on every keystroke
+    print("="*70); print(f"🔎 SEARCH > {query}"); print("="*70)
+    for i, path in enumerate(results[:20]):
+        info = f"  ({format_time(meta[path][0])}, {meta[path][1]} trk)" if path in meta else ""
+        mark = "▶" if i == cursor else " "
+        print(f"{mark}[{i+1}] {os.path.basename(path)}{info}  · {os.path.relpath(os.path.dirname(path), CONFIG['midi_root'])}")
+    print("-"*70); print(f"{len(results)} shown | ranked in {took_ms:.1f}ms")
+
+def run_search_picker(msvcrt, search, meta):
+    """Search-as-you-type loop of run_search_menu (Windows console)."""
+    query = ""; results = []; took = 0.0; cursor = 0
+    print_search_results(query, results, meta)
+    while True:
+        ch = msvcrt.getwch()
+        if ch in ("\x00", "\xe0"): # Arrow keys arrive as a prefix + code
+            code = msvcrt.getwch()
+            if code == "H": cursor = max(cursor - 1, 0)
+            elif code == "P": cursor = min(cursor + 1, max(min(len(results), 20) - 1, 0))
+        elif ch == "\x1b": return
+        elif ch == "\r":
+            if results: COMMANDS.put("play", (results, f"SEARCH: {query}", cursor))
+            return
+        elif ch == "\t":
+            if results: COMMANDS.put("enqueue", [results[cursor]])
+            continue
+        elif ch == "\b": query = query[:-1]; results, took = search(query); cursor = 0
+        elif ch.isprintable(): query += ch; results, took = search(query); cursor = 0
+        print_search_results(query, results, meta, cursor, took)
+
+def run_search_menu():
+    """
+    Fuzzy search over the whole library. On Windows it searches as you type: arrows move, ENTER plays
+    from the highlighted song (the results become the playlist), TAB queues it, ESC leaves.
+    Elsewhere: type a query + ENTER, then `3` plays result 3, `+3` queues it, `+` queues them all.
+    """
+    ensure_library()
+    if not SEARCH_INDEX.ids: print("Indexing library..."); sync_search_index()
+    meta = get_library_metadata()
+    def search(query):
+        started = time.perf_counter(); results = SEARCH_INDEX.search(query)
+        return results, (time.perf_counter() - started) * 1000
+    try:
+        import msvcrt # Key-at-a-time console input (Windows only)
+    except ImportError:
+        msvcrt = None
+
+    if msvcrt:
+        suspend_hotkeys(NAV_HOTKEYS) # Arrows move the cursor here, not the playback speed / song
+        try: return run_search_picker(msvcrt, search, meta)
+        finally: resume_hotkeys(NAV_HOTKEYS)
+
+    query = input("\nSearch > ").strip()
+    while query:
+        results, took = search(query)
+        print_search_results(query, results, meta, None, took)
+        choice = input("# to play, +# to queue, + to queue all, or a new search > ").strip()
+        if choice == "+":
+            if results: COMMANDS.put("enqueue", results[:20])
+            return
+        number = choice[1:] if choice.startswith("+") else choice
+        if number.isdigit() and 1 <= int(number) <= min(len(results), 20):
+            if choice.startswith("+"): COMMANDS.put("enqueue", [results[int(number) - 1]])
+            else: COMMANDS.put("play", (results, f"SEARCH: {query}", int(number) - 1))
+            return
+        query = choice
 
 def run_selection_menu():
-    os.system('cls' if os.name == 'nt' else 'clear')
-    subfolders = get_subfolders()
-    print("="*50); print("      📂 PLAYLIST SELECTION"); print("="*50); print(f"[1]  🔥 ALL SONGS (Master)")
+    clear_screen()
+    subfolders = get_subfolders() # From the index: instant; a background refresh catches up with disk
+    refresh_library_async()
+    print("="*50); print("      📂 PLAYLIST SELECTION"); print("="*50)
+    resume = state["resume_point"]
+    if resume: print(f"[R]  ⏯️  RESUME: {os.path.basename(resume['playlist'][resume['index']])} @ {format_time(resume['position'])}")
+    print("[S]  🔎 SEARCH"); print("[1]  🔥 ALL SONGS (Master)")
     for i, folder in enumerate(subfolders): print(f"[{i+2}]  📂 {folder}")
+    UI_SHOWN.set()
     try:
         user_input = input("\nSelect Folder # > ")
         if not user_input: return
+        if user_input.strip().lower() == "s": return run_search_menu()
+        if user_input.strip().lower() == "r" and resume: COMMANDS.put("resume", resume); return
         
         choice = int(user_input)
         temp_playlist = []; temp_folder_name = "ALL"
@@ -414,224 +1736,859 @@ def run_selection_menu():
         else: return
 
         if temp_playlist:
-            os.system('cls' if os.name == 'nt' else 'clear')
+            clear_screen()
             print(f"--- SONGS IN: {temp_folder_name} ---")
+            meta = get_library_metadata()
             for i, full_path in enumerate(temp_playlist): 
-                print(f"[{i+1}] {os.path.basename(full_path)}")
+                info = f"  ({format_time(meta[full_path][0])}, {meta[full_path][1]} trk)" if full_path in meta else ""
+                print(f"[{i+1}] {os.path.basename(full_path)}{info}")
             
             print("\n(Enter number to Play, or leave empty to Cancel)")
             si = input("Start Song # > ")
             
             if si.strip():
-                state["playlist"] = temp_playlist
-                state["current_folder_name"] = temp_folder_name
-                state["current_index"] = int(si) - 1
-                state["restart_flag"] = True
-                state["resume_from_tick"] = 0
-                state["manual_track_indices"] = None
+                COMMANDS.put("play", (temp_playlist, temp_folder_name, int(si) - 1))
             else:
                 print("Selection Cancelled.")
                 time.sleep(0.5)
     except: pass
 
 # ============================================================================
-# 10. PLAYBACK LOOP
+# 11. PLAYBACK LOOP
 # ============================================================================
-def handle_seek_request(accumulated_time, total_duration, mid, tempo):
-    if not state["seek_request"]: return False
+def apply_command(kind, arg, stamp, position_sec=0.0, total_duration=0.0, tempo_map=None):
+    """
+    Applies one player command at song position position_sec (player thread only).
+    Returns kind if playback has to stop and restart from state (seek/skip/play/resume/restart/mixer/stop),
+    else None. Pause is handled by the caller, which owns the clock.
+    """
+    if kind == "speed":
+        state["playback_speed"] = min(max(state["playback_speed"] + arg, 0.1), 10.0)
+        return None
+    if kind == "enqueue": # Append to the playlist; playback carries on (an idle player starts on it)
+        if not state["playlist"]: state["current_index"] = 0
+        state["playlist"] = state["playlist"] + arg
+        return None
+    if kind == "seek":
+        if tempo_map is None: return None
+        target_sec = min(max(position_sec + arg, 0.0), total_duration)
+        state["resume_from_tick"] = int(seconds_to_tick(tempo_map, target_sec))
+    elif kind == "skip":
+        if not state["playlist"]: return None
+        state["current_index"] = (state["current_index"] + arg) % len(state["playlist"])
+        state["resume_from_tick"] = 0; state["manual_track_indices"] = None
+    elif kind == "play":
+        state["playlist"], state["current_folder_name"], state["current_index"] = arg
+        state["resume_from_tick"] = 0; state["manual_track_indices"] = None; state["resume_point"] = None
+    elif kind == "resume": # A resume_point: like play, but from its position and mix
+        seed_resume_timeline(arg)
+        state["playlist"], state["current_folder_name"], state["current_index"] = arg["playlist"], arg["folder"], arg["index"]
+        state["resume_from_tick"] = arg["tick"]; state["manual_track_indices"] = arg["manual"]; state["resume_point"] = None
+    elif kind == "restart":
+        full_path, indices = arg
+        if state["playlist"] and state["playlist"][state["current_index"]] == full_path and indices:
+            state["manual_track_indices"] = indices
+    elif kind == "mixer":
+        if tempo_map is None: return None
+        state["resume_from_tick"] = int(seconds_to_tick(tempo_map, position_sec))
+    state["control_at"] = stamp
+    return kind
 
-    target_sec = -1
-    request = state["seek_request"]
-    
-    if request == "forward":
-        target_sec = min(accumulated_time + CONFIG["seek_step"], total_duration)
-    elif request == "backward":
-        target_sec = max(accumulated_time - CONFIG["seek_step"], 0.0)
-    elif request == "fine_forward":
-        target_sec = min(accumulated_time + CONFIG["fine_seek_step"], total_duration)
-    elif request == "fine_backward":
-        target_sec = max(accumulated_time - CONFIG["fine_seek_step"], 0.0)
-
-    if target_sec != -1:
-        target_ticks = mido.second2tick(target_sec, mid.ticks_per_beat, tempo)
-        state["resume_from_tick"] = int(target_ticks)
-        state["restart_flag"] = True
-        state["seek_request"] = None # Reset request
-        return True
-        
-    state["seek_request"] = None # Reset request
-    return False
+# --- INSTRUMENTATION ---
+class Histogram:
+    """
+    HDR-style log-linear histogram of integer samples (microseconds): 16 linear buckets per power
+    of two (<= 1/16 relative error) in one preallocated array, so record() never grows anything.
+    """
+    SUB_BITS = 5
+
+    def __init__(self, max_value=1 << 26): # ~67 s
+        self.size = self.index(max_value) + 1
+        self.counts = array('L', [0]) * self.size
+        self.total = 0; self.max = 0
+
+    @classmethod
+    def index(cls, value):
+        shift = value.bit_length() - cls.SUB_BITS
+        return value if shift <= 0 else (shift << (cls.SUB_BITS - 1)) + (value >> shift)
+
+    @classmethod
+    def value_at(cls, idx):
+        """Lower bound of bucket idx (inverse of index)."""
+        if idx < 1 << cls.SUB_BITS: return idx
+        shift = (idx >> (cls.SUB_BITS - 1)) - 1
+        return (idx - (shift << (cls.SUB_BITS - 1))) << shift
+
+    def record(self, value):
+        if value < 0: value = 0
+        idx = self.index(value)
+        self.counts[idx if idx < self.size else self.size - 1] += 1
+        self.total += 1
+        if value > self.max: self.max = value
+
+    def reset(self):
+        self.counts = array('L', [0]) * self.size; self.total = 0; self.max = 0
+
+    def percentile(self, q):
+        """Upper edge of the bucket holding the q-quantile (capped at the max seen), in microseconds."""
+        if not self.total: return 0
+        want = q * self.total; seen = 0
+        for idx, n in enumerate(self.counts):
+            seen += n
+            if seen >= want: return min(self.value_at(idx + 1) - 1, self.max)
+        return self.max
+
+    def summary(self):
+        return {"count": self.total, "p50_ms": self.percentile(0.5) / 1000, "p99_ms": self.percentile(0.99) / 1000,
+                "max_ms": self.max / 1000}
+
+class RingLog:
+    """Fixed-size per-chord timing rows (chord, notes, scheduled, actual, emit done); overwrites the oldest."""
+    def __init__(self, size):
+        self.size = max(size, 1); self.count = 0
+        self.chord = array('L', [0]) * self.size; self.notes = array('H', [0]) * self.size
+        self.due = array('d', [0.0]) * self.size; self.at = array('d', [0.0]) * self.size; self.done = array('d', [0.0]) * self.size
+
+    def add(self, chord, notes, due, at, done):
+        k = self.count % self.size
+        self.chord[k] = chord; self.notes[k] = notes; self.due[k] = due; self.at[k] = at; self.done[k] = done
+        self.count += 1
+
+    def rows(self):
+        """Oldest to newest."""
+        first = max(0, self.count - self.size)
+        for n in range(first, self.count):
+            k = n % self.size
+            yield self.chord[k], self.notes[k], self.due[k], self.at[k], self.done[k]
+
+class PlaybackStats:
+    """
+    Per-song timing of the playback worker: chord lateness (actual emit vs. scheduled deadline),
+    emit cost, final-spin time, prepare time, pause/seek/skip response time and GC pauses.
+    """
+    def __init__(self):
+        self.lateness = Histogram(); self.emit = Histogram(); self.spin = Histogram()
+        self.prepare = Histogram(); self.control = Histogram(); self.gc = Histogram()
+        self.log = RingLog(CONFIG["stats_ring"]); self.gc_start = 0.0
+
+    def reset(self):
+        for hist in (self.lateness, self.emit, self.spin, self.prepare, self.control, self.gc): hist.reset()
+        self.log = RingLog(CONFIG["stats_ring"])
+
+    def chord(self, chord, notes, due, at, done):
+        self.lateness.record(int((at - due) * 1e6))
+        self.emit.record(int((done - at) * 1e6))
+        self.log.add(chord, notes, due, at, done)
+
+    def control_done(self):
+        at = state["control_at"]
+        if at is not None:
+            state["control_at"] = None
+            self.control.record(int((time.perf_counter() - at) * 1e6))
+
+    def on_gc(self, phase, info):
+        if phase == "start": self.gc_start = time.perf_counter()
+        else: self.gc.record(int((time.perf_counter() - self.gc_start) * 1e6))
+
+    def brief(self):
+        """Compact dashboard suffix (empty until a chord has played)."""
+        if not self.lateness.total: return ""
+        late = self.lateness
+        return (f" | Late {late.percentile(0.5) / 1000:.1f}/{late.percentile(0.99) / 1000:.1f}/{late.max / 1000:.1f}ms"
+                f" Emit {self.emit.percentile(0.99) / 1000:.2f}ms")
+
+    def summary(self):
+        return {name: getattr(self, name).summary() for name in ("lateness", "emit", "spin", "prepare", "control", "gc")}
 
-def wait_for_playback(real_wait, accumulated_time, total_duration, mid, tempo):
-    start_wait = time.time()
+    def dump(self, song_name):
+        """Writes the song's timing to stats_dir as CSV (per-chord rows) or JSON (summary + rows)."""
+        if not CONFIG["stats_dump"] or not self.lateness.total: return
+        os.makedirs(CONFIG["stats_dir"], exist_ok=True)
+        base = os.path.join(CONFIG["stats_dir"], f"{os.path.splitext(song_name)[0]}.{time.strftime('%Y%m%d-%H%M%S')}")
+        rows = list(self.log.rows()); origin = rows[0][2]
+        rows = [(c, n, round(due - origin, 6), round(at - origin, 6), round((at - due) * 1000, 3), round((done - at) * 1000, 3))
+                for c, n, due, at, done in rows]
+        header = ("chord", "notes", "scheduled_s", "actual_s", "lateness_ms", "emit_ms")
+        if CONFIG["stats_dump"] == "csv":
+            with open(base + ".csv", "w") as f:
+                f.write(",".join(header) + "\n")
+                f.writelines(",".join(map(str, row)) + "\n" for row in rows)
+        else:
+            with open(base + ".json", "w") as f:
+                output = get_output()
+                json.dump({"song": song_name, "summary": self.summary(),
+                           "window": {"attempts": output.resolve_attempts, "failures": output.resolve_failures},
+                           "ensemble": ENSEMBLE.summary() if CONFIG["ensemble_parts"] > 1 else None,
+                           "columns": header, "chords": rows}, f)
+
+STATS = PlaybackStats()
+
+class PlaybackClock:
+    """
+    Maps song seconds to absolute perf_counter deadlines from a single origin,
+    so emit costs never accumulate. Rebases on speed changes and after pauses.
+    """
+    def __init__(self, song_sec=0.0):
+        self.start(song_sec)
+
+    def start(self, song_sec):
+        self.origin = time.perf_counter()
+        self.origin_sec = song_sec
+        self.speed = state["playback_speed"]
+        self.base = (self.origin, self.origin_sec, self.speed) # One assignment: a consistent read for other threads
+
+    def song_time(self, now=None):
+        if now is None: now = time.perf_counter()
+        return self.origin_sec + (now - self.origin) * self.speed
+
+    def deadline(self, song_sec):
+        if state["playback_speed"] != self.speed: self.start(self.song_time())
+        return self.origin + (song_sec - self.origin_sec) / self.speed
+
+class RateLimiter:
+    """
+    Sliding-window output budget: at most rate_limit_msgs messages per rate_limit_window.
+    Keeps the send times of the last rate_limit_msgs messages in a ring; reserve(n) blocks until
+    n more fit (never longer than one window) and returns True if it had to wait.
+    """
+    def __init__(self):
+        self.limit = max(CONFIG["rate_limit_msgs"], 1); self.window = CONFIG["rate_limit_window"]
+        self.sent = array('d', [float("-inf")]) * self.limit; self.pos = 0
+
+    def reserve(self, n):
+        if self.window <= 0: return False
+        n = min(n, self.limit) # A chord over budget (could not be thinned further) goes out as one burst
+        ready = self.sent[(self.pos + n - 1) % self.limit] + self.window
+        now = time.perf_counter(); delayed = ready > now
+        if delayed:
+            if ready - now > CONFIG["spin_margin"]: time.sleep(ready - now - CONFIG["spin_margin"])
+            while time.perf_counter() < ready: pass
+            now = time.perf_counter()
+        for k in range(n): self.sent[(self.pos + k) % self.limit] = now
+        self.pos = (self.pos + n) % self.limit
+        return delayed
+
+def pause_playback(paused_at, clock, total_duration, tempo_map):
+    """
+    Holds the song at paused_at until the next pause toggle, then rebases the clock.
+    Returns the interrupting command kind if something else ended the pause (state["paused"] stays set).
+    """
+    state["dashboard"]["paused_at"] = paused_at
+    while state["running"]:
+        kind, arg, stamp = COMMANDS.get()
+        if kind == "pause":
+            state["paused"] = False; clock.start(paused_at); state["dashboard"]["paused_at"] = None
+            STATS.control.record(int((time.perf_counter() - stamp) * 1e6))
+            return None
+        interrupted = apply_command(kind, arg, stamp, paused_at, total_duration, tempo_map)
+        if interrupted: return interrupted
+    return "stop"
+
+def wait_for_playback(target_sec, clock, total_duration, tempo_map, on_pause=None):
+    """
+    Blocks until the song clock reaches target_sec: coarse sleep on the command queue (any command
+    wakes it at once), then a short final spin. Returns the command kind that interrupted
+    playback (seek/skip/mixer/...), or None. on_pause runs once when a pause begins (e.g. to release held keys).
+    """
     while True:
-        # Handle Pause
-        while state["paused"]:
-            update_dashboard(accumulated_time, total_duration)
-            time.sleep(0.1)
-            if state["restart_flag"] or state["request_track_mixer"]: return True
-            if handle_seek_request(accumulated_time, total_duration, mid, tempo): return True
+        now = time.perf_counter()
+        current_sec = min(clock.song_time(now), target_sec)
+
+        # Pause: freeze the song clock, rebase when resumed (also re-entered after a seek while paused)
+        if state["paused"]:
+            if on_pause: on_pause()
+            interrupted = pause_playback(current_sec, clock, total_duration, tempo_map)
+            if interrupted: return interrupted
+            continue
 
-        # Check Interrupts
-        if state["restart_flag"] or state["request_track_mixer"]: return True
-        if handle_seek_request(accumulated_time, total_duration, mid, tempo): return True
+        # Commands, oldest first
+        command = COMMANDS.pop()
+        while command:
+            kind, arg, stamp = command
+            if kind == "pause":
+                state["paused"] = True; STATS.control.record(int((time.perf_counter() - stamp) * 1e6))
+                break
+            interrupted = apply_command(kind, arg, stamp, current_sec, total_duration, tempo_map)
+            if interrupted: return interrupted
+            command = COMMANDS.pop()
+        if state["paused"]: continue
 
         # Check Time
-        elapsed = time.time() - start_wait
-        target_wait = real_wait / state["playback_speed"]
-        if elapsed >= target_wait: return False
-        
-        # Update UI & Sleep
-        update_dashboard(accumulated_time, total_duration)
+        deadline = clock.deadline(target_sec)
+        remaining = deadline - now
+        if remaining <= 0: return None
+
+        if remaining > CONFIG["spin_margin"]:
+            # Sleep (any command ends this early); the renderer reads the clock, so no UI wake-ups
+            COMMANDS.wait(remaining - CONFIG["spin_margin"])
+        else:
+            while time.perf_counter() < deadline: pass
+            STATS.spin.record(int((time.perf_counter() - now) * 1e6))
+            return None
+
+class SwitchInterval:
+    """
+    Single owner of sys.setswitchinterval. Threads request() a value and release() it when done; the
+    smallest outstanding request applies, and the interpreter's own value returns once none are left.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = Counter(); self.base = None
+
+    def request(self, interval):
+        with self.lock:
+            if not self.requests: self.base = sys.getswitchinterval()
+            self.requests[interval] += 1
+            sys.setswitchinterval(min(self.requests))
+
+    def release(self, interval):
+        with self.lock:
+            self.requests[interval] -= 1
+            if self.requests[interval] <= 0: del self.requests[interval]
+            sys.setswitchinterval(min(self.requests) if self.requests else self.base)
+
+SWITCH_INTERVAL = SwitchInterval()
+
+PREFETCH_QUEUE = queue.Queue()
+
+def request_prefetch():
+    """Queue the songs the player may jump to next: next, previous (wrapping, like next/prev/loop do)."""
+    playlist = state["playlist"]
+    if not CONFIG["prefetch"] or len(playlist) < 2: return
+    idx = state["current_index"]
+    PREFETCH_QUEUE.put([playlist[(idx + 1) % len(playlist)], playlist[(idx - 1) % len(playlist)]])
+
+def prefetch_worker():
+    """
+    Warms the song/timeline caches for neighbouring playlist entries and refreshes the window
+    handle, so skipping and song changes start from memory instead of a parse + EnumWindows.
+    """
+    while state["running"]:
+        paths = PREFETCH_QUEUE.get()
+        while not PREFETCH_QUEUE.empty(): paths = PREFETCH_QUEUE.get_nowait() # Only the latest request matters
+
+        # Parsing holds the GIL; a short switch interval keeps the player's wake-ups prompt meanwhile
+        SWITCH_INTERVAL.request(0.0005)
+        try:
+            for path in paths:
+                song = load_song(path)
+                if not song: continue
+                indices, _, _, transpose = resolve_track_selection(path, song)
+                build_timeline(song, indices, transpose)
+            get_output().get_target() # Validate early: a stale window starts re-resolving before the next song
+        except Exception:
+            pass # Best effort: the player falls back to loading on demand
+        finally:
+            SWITCH_INTERVAL.release(0.0005)
+
+# --- RESUME SNAPSHOT ---
+# Same layout as a compiled song: <magic, version, meta_len> + JSON meta (playlist, position, keys,
+# array layout) + the playing song's compiled timeline as raw 8-byte aligned arrays.
+RESUME_MAGIC = b"JKRS"
+RESUME_FORMAT_VERSION = 2 # 2: auto_mix from the channel-10 drum flag
+TIMELINE_ARRAYS = ("times", "secs", "chord_start", "notes", "tracks")
+ACTION_COUNTS = ("naive_count", "saved_count", "folded_count", "thinned_count")
+
+def save_resume_snapshot():
+    """Writes the playlist, the position and the playing song's timeline to resume_file (at exit)."""
+    path = CONFIG["resume_file"]; playlist = state["playlist"]; now_playing = state["now_playing"]
+    if not path or not playlist or not now_playing: return
+    song, timeline = now_playing; index = state["current_index"]
+    meta = {"byteorder": sys.byteorder, "playlist": playlist, "folder": state["current_folder_name"], "index": index,
+            "manual": state["manual_track_indices"], "tick": 0, "position": 0.0, "arrays": []}
+    blobs = []
+    if playlist[index] == song["key"][0]: # Else the player already moved on: start the next song from the top
+        tick = state["resume_from_tick"] # A seek / mixer round-trip not yet applied
+        if not tick:
+            dash = state["dashboard"]
+            tick = int(seconds_to_tick(song["tempo_map"], min(max(playback_position(dash), 0.0), dash["total"])))
+        arrays = {name: timeline[name] for name in TIMELINE_ARRAYS}
+        arrays.update((f"actions.{name}", a) for name, a in timeline["actions"].items() if isinstance(a, array))
+        offset = 0
+        for name, a in arrays.items():
+            raw = a.tobytes(); raw += b"\0" * (-len(raw) % 8)
+            meta["arrays"].append([name, a.typecode, a.itemsize, offset, len(a)])
+            blobs.append(raw); offset += len(raw)
+        meta.update(tick=tick, position=tick_to_seconds(song["tempo_map"], tick), song_key=list(song["key"]),
+                    timeline_key=list(timeline["key"]), transpose=timeline["transpose"], auto_mix=song.get("auto_mix"),
+                    counts={name: timeline["actions"][name] for name in ACTION_COUNTS})
+    meta = json.dumps(meta).encode("utf-8")
+    header = CACHE_HEADER.pack(RESUME_MAGIC, RESUME_FORMAT_VERSION, len(meta)) + meta
+    header += b"\0" * (-len(header) % 8)
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            for blob in blobs: f.write(blob)
+        os.replace(tmp_path, path)
+    except OSError: pass # Best effort: the next launch just shows the menu without [R]
+
+def load_resume_snapshot():
+    """
+    Reads resume_file back, checking the song file with a stat only (no hash, no parse), so it can
+    run before the first menu. Returns the resume_point ("resume" command argument), or None. If the
+    file is unchanged the point carries the compiled timeline for seed_resume_timeline.
+    """
+    path = CONFIG["resume_file"]
+    if not path: return None
+    try:
+        with open(path, "rb") as f: data = f.read()
+        magic, version, meta_len = CACHE_HEADER.unpack_from(data, 0)
+        if magic != RESUME_MAGIC or version != RESUME_FORMAT_VERSION: return None
+        meta = json.loads(data[CACHE_HEADER.size:CACHE_HEADER.size + meta_len].decode("utf-8"))
+        point = {k: meta[k] for k in ("playlist", "folder", "index", "tick", "manual", "position")}
+        full_path = point["playlist"][point["index"]]
+    except (OSError, ValueError, KeyError, IndexError, TypeError, struct.error):
+        return None
+    if not meta["arrays"]: return point
+
+    try: st = os.stat(full_path)
+    except OSError: st = None
+    if st is None or [full_path, st.st_mtime_ns, st.st_size] != meta["song_key"]:
+        point["tick"] = 0; point["position"] = 0.0 # Edited (or gone) since: the position means nothing now
+    elif meta["byteorder"] == sys.byteorder:
+        base = CACHE_HEADER.size + meta_len; base += -base % 8
+        point["timeline"] = (meta, memoryview(data)[base:])
+    return point
+
+def seed_resume_timeline(point):
+    """
+    Puts a resume_point's compiled timeline into SONG_CACHE under the key the player will look it up
+    by, so resuming starts without a merge. Runs on the player thread as the "resume" command is
+    applied: the load_song it needs (hash, maybe a parse) stays off the startup path.
+    """
+    if "timeline" not in point: return
+    meta, view = point.pop("timeline")
+    song = load_song(point["playlist"][point["index"]])
+    if not song or list(song["key"]) != meta["song_key"]: return # Changed since the menu was shown
+    arrays = {}
+    for name, typecode, itemsize, offset, count in meta["arrays"]:
+        a = array(typecode)
+        if a.itemsize != itemsize: return # Written by another platform: the player rebuilds it
+        a.frombytes(view[offset:offset + itemsize * count])
+        arrays[name] = a
+    key = tuple(tuple(k) if isinstance(k, list) else k for k in meta["timeline_key"])
+    timeline = {name: arrays[name] for name in TIMELINE_ARRAYS}
+    timeline.update(transpose=meta["transpose"], key=key)
+    timeline["actions"] = {name[8:]: a for name, a in arrays.items() if name.startswith("actions.")}
+    timeline["actions"].update(meta["counts"])
+    if meta["auto_mix"] and "auto_mix" not in song: song["auto_mix"] = meta["auto_mix"]
+
+    # The chosen transposition may have been saved since (at the latest when the song stopped):
+    # the same timeline then resolves under that shift instead of None
+    size = 1024 + sum(a.itemsize * len(a) for a in arrays.values())
+    for k in {key, key[:5] + (timeline["transpose"],) + key[6:]}: SONG_CACHE.put(k, timeline, size)
+
+# --- ENSEMBLE: one clock, several windows ---
+class SkewMeter:
+    """
+    Inter-window skew: for each moment where several windows have a chord due (a shared tick),
+    the spread between the first and last actual send, in microseconds.
+    """
+    def __init__(self):
+        self.lock = threading.Lock(); self.open = {}; self.seq = 0
+        self.hist = Histogram()
+
+    def expect(self, count):
+        """Registers a dispatch to count windows; returns its sequence number for report()."""
+        with self.lock:
+            self.seq += 1
+            if count > 1: self.open[self.seq] = [count, float("inf"), float("-inf")]
+            return self.seq
+
+    def report(self, seq, at):
+        """at: when this window sent its chord, or None if it skipped it."""
+        with self.lock:
+            slot = self.open.get(seq)
+            if slot is None: return
+            slot[0] -= 1
+            if at is not None: slot[1] = min(slot[1], at); slot[2] = max(slot[2], at)
+            if not slot[0]:
+                del self.open[seq]
+                if slot[2] > slot[1]: self.hist.record(int((slot[2] - slot[1]) * 1e6))
+
+class EnsemblePart:
+    """
+    One window of an ensemble, with its own track subset, rate limiter and output thread. The player
+    thread only hands it ("chord", index, deadline, seq) when a chord is due (and "song" / "flush"); the part sends it and
+    times its own key releases, so a slow window delays nobody else.
+    """
+    def __init__(self, index, skew):
+        self.index = index; self.skew = skew
+        self.target = None; self.tracks = []
+        self.inbox = queue.Queue(); self.limiter = RateLimiter()
+        self.lateness = Histogram(); self.delayed = 0; self.skipped = 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        actions = None; target = None; paced = False; pending = []; send = send_batch = None
+        reserve = self.limiter.reserve
+        def release(until=None):
+            while pending and (until is None or pending[0][0] <= until):
+                j = heapq.heappop(pending)[1]
+                if reserve(1) and actions["flags"][j] & ACT_STRUM: self.delayed += 1
+                send(target, actions["msg"][j], actions["wparam"][j], actions["lparam"][j])
+
+        while True:
+            try: item = self.inbox.get(timeout=max(0.0, pending[0][0] - time.perf_counter()) if pending else None)
+            except queue.Empty: release(time.perf_counter()); continue
+            kind = item[0]
+            if kind != "chord":
+                release() # Song change, pause/seek: never leave a key held
+                if kind == "song":
+                    _, actions, target, paced, output = item; send = output.send; send_batch = output.send_batch
+                continue
+
+            _, i, due, seq = item
+            release() # Still held when the next chord is due: up first, so no key re-presses while down
+            if time.perf_counter() - due > CONFIG["ensemble_max_lag"]: # Stalled window: rejoin the others
+                self.skipped += 1; self.skew.report(seq, None); continue
+            start = actions["start"][i]; end = actions["start"][i + 1]
+            if not paced:
+                if reserve(end - start): self.delayed += actions["notes"][i]
+                at = time.perf_counter()
+                send_batch(target, actions["msg"], actions["wparam"], actions["lparam"], start, end)
+            else:
+                at = time.perf_counter(); offsets = actions["at"]
+                for j in range(start, end):
+                    if offsets[j] <= 0:
+                        if reserve(1) and actions["flags"][j] & ACT_STRUM: self.delayed += 1
+                        send(target, actions["msg"][j], actions["wparam"][j], actions["lparam"][j])
+                    else: heapq.heappush(pending, (at + offsets[j], j))
+            self.lateness.record(int((at - due) * 1e6))
+            self.skew.report(seq, at)
+
+class Ensemble:
+    """The parts of ensemble mode (created on first use; their threads live as long as the player)."""
+    def __init__(self):
+        self.parts = []; self.skew = SkewMeter()
+
+    def ensure(self, output, count):
+        """count parts, each with a valid window: all are re-resolved together if any went stale."""
+        while len(self.parts) < count: self.parts.append(EnsemblePart(len(self.parts), self.skew))
+        parts = self.parts[:count]
+        if not all(output.is_valid(part.target) for part in parts):
+            handles = output.find_targets(count)
+            for part in parts: part.target = handles[part.index] if part.index < len(handles) else None
+        return parts
+
+    def reset(self):
+        self.skew.hist.reset()
+        for part in self.parts: part.lateness.reset(); part.delayed = 0; part.skipped = 0
+
+    def brief(self):
+        """Dashboard suffix: skew p99/max and the latest-running window's p99 lateness."""
+        if not self.parts or not any(part.lateness.total for part in self.parts): return ""
+        skew = self.skew.hist; late = max(part.lateness.percentile(0.99) for part in self.parts)
+        return f" | Skew {skew.percentile(0.99) / 1000:.1f}/{skew.max / 1000:.1f}ms Win late {late / 1000:.1f}ms"
+
+    def summary(self):
+        return {"skew": self.skew.hist.summary(),
+                "windows": [{"target": part.target, "tracks": part.tracks, "delayed": part.delayed, "skipped": part.skipped,
+                             "lateness": part.lateness.summary()} for part in self.parts]}
+
+ENSEMBLE = Ensemble()
+
+def ensemble_steps(song, timelines):
+    """
+    Merges the parts' chord lists into one schedule: step s is the unique tick ticks[s] at secs[s],
+    with chords (part[k], chord[k]) for k in first[s]:first[s+1]. Cached on the song for its last assignment.
+    """
+    cached = song.get("ensemble_steps")
+    if cached and len(cached[0]) == len(timelines) and all(a is b for a, b in zip(cached[0], timelines)): return cached[1]
+    events = sorted((tl["actions"]["ticks"][i], p, i) for p, tl in enumerate(timelines) for i in range(len(tl["actions"]["ticks"])))
+    ticks = array('q'); secs = array('d'); first = array('L'); part = array('H'); chord = array('L'); notes = array('L')
+    for tick, p, i in events:
+        if not ticks or ticks[-1] != tick:
+            ticks.append(tick); secs.append(timelines[p]["actions"]["secs"][i]); first.append(len(part)); notes.append(0)
+        part.append(p); chord.append(i); notes[-1] += timelines[p]["actions"]["notes"][i]
+    first.append(len(part))
+    steps = {"ticks": ticks, "secs": secs, "first": first, "part": part, "chord": chord, "notes": notes}
+    song["ensemble_steps"] = (list(timelines), steps)
+    return steps
+
+def play_ensemble(song, full_path, timeline, tempo_map, total_duration, song_start):
+    """
+    Ensemble tick loop: each window plays its own track subset of the song (same transposition),
+    all from one clock. This thread only waits for each step and dispatches it to the parts.
+    Returns the interrupting command kind, or None at the end of the song.
+    """
+    count = CONFIG["ensemble_parts"]; output = get_output(); dash = state["dashboard"]
+    parts = ENSEMBLE.ensure(output, count)
+    assignment = resolve_ensemble_parts(full_path, song, sorted(set(timeline["tracks"])), count)
+    timelines = [build_timeline(song, tracks, timeline["transpose"]) for tracks in assignment]
+    steps = ensemble_steps(song, timelines)
+    paced = CONFIG["note_hold_time"] > 0 or CONFIG["chord_strum_delay"] > 0
+    for part, tracks, tl in zip(parts, assignment, timelines):
+        part.tracks = tracks; part.inbox.put(("song", tl["actions"], part.target, paced, output))
+    dash["thinned"] = sum(tl["actions"]["thinned_count"] for tl in timelines)
+    dash["ensemble"] = [(part.index + 1, part.tracks, part.target is not None) for part in parts]
+
+    step_secs = steps["secs"]; first = steps["first"]; step_part = steps["part"]; step_chord = steps["chord"]
+    inboxes = [part.inbox.put for part in parts]; expect = ENSEMBLE.skew.expect
+    live = [part.target is not None for part in parts] # A part without a window sits the song out
+    def release_all():
+        for put in inboxes: put(("flush",))
+    start_index, clock = start_clock(steps["ticks"], tempo_map)
+    record_chord = STATS.chord; load_source = LOAD_INFO.source; first_note = True
+
+    # The final spin before each step holds the GIL; a short switch interval lets the parts' threads
+    # (just handed the previous step) take it promptly instead of after the default 5 ms
+    switch_interval = CONFIG["ensemble_switch_interval"]; SWITCH_INTERVAL.request(switch_interval)
+    interrupted = None
+    for s in range(start_index, len(step_secs)):
+        if not state["running"]: break
+        interrupted = wait_for_playback(step_secs[s], clock, total_duration, tempo_map, release_all)
+        if interrupted: break
+        if state["muted"]: continue
+
+        due = clock.deadline(step_secs[s]); at = time.perf_counter()
+        seq = expect(sum(live[step_part[k]] for k in range(first[s], first[s + 1])))
+        for k in range(first[s], first[s + 1]):
+            if live[step_part[k]]: inboxes[step_part[k]](("chord", step_chord[k], due, seq))
+        record_chord(s, steps["notes"][s], due, at, time.perf_counter()) # Dispatch timing; windows keep their own
+
+        if first_note:
+            first_note = False
+            dash["start_ms"] = ((clock.origin - song_start) + max(0.0, at - due)) * 1000; dash["load_source"] = load_source
+
+    SWITCH_INTERVAL.release(switch_interval); release_all()
+    dash["delayed"] = sum(part.delayed for part in parts)
+    return interrupted
+
+def start_clock(ticks, tempo_map):
+    """Consumes the pending resume tick: (index of the first chord at/after it in ticks, a clock started there)."""
+    resume_tick = state["resume_from_tick"]
+    state["resume_from_tick"] = 0
+    start_sec = tick_to_seconds(tempo_map, resume_tick) if resume_tick > 0 else 0.0
+    clock = state["clock"] = PlaybackClock(start_sec)
+    STATS.control_done() # Seek / skip: playing again from the new position
+    return bisect.bisect_left(ticks, resume_tick), clock
+
+def play_solo(timeline, tempo_map, total_duration, song_start, limiter):
+    """
+    Plays timeline into the one target window from the pending resume tick.
+    Returns the command kind that interrupted it (seek/skip/mixer/...), or None at the end of the song.
+    """
+    # Cached window, validated (exists + title) rather than re-enumerated on every start/seek
+    output = get_output(); hwnd = output.get_target()
+    
+    # --- COMPILED STREAM: everything below is just wait + emit ---
+    actions = timeline["actions"]
+    chord_ticks = actions["ticks"]; chord_secs = actions["secs"]; chord_start = actions["start"]
+    msgs = actions["msg"]; wparams = actions["wparam"]; lparams = actions["lparam"]; flags = actions["flags"]
+    chord_notes = actions["notes"]; reserve = limiter.reserve; dash = state["dashboard"]
+    dash["thinned"] = actions["thinned_count"]
+    send = output.send; send_batch = output.send_batch
+    paced = CONFIG["note_hold_time"] > 0 or CONFIG["chord_strum_delay"] > 0
+    offsets = actions["at"]
+
+    # --- PENDING RELEASES: (perf_counter deadline, record) for held keys & strummed notes ---
+    pending = []
+    def flush_pending(until=None):
+        while pending and (until is None or pending[0][0] <= until):
+            j = heapq.heappop(pending)[1]
+            if reserve(1) and flags[j] & ACT_STRUM: dash["delayed"] += 1
+            send(hwnd, msgs[j], wparams[j], lparams[j])
+
+    start_index, clock = start_clock(chord_ticks, tempo_map)
+    record_chord = STATS.chord
+    load_source = LOAD_INFO.source; first_note = True
+
+    # --- TICK LOOP ---
+    interrupted = None
+    for i in range(start_index, len(chord_ticks)):
+        if not state["running"]: break
+
+        # --- WAIT for the chord's absolute deadline (Handles Speed/Pause/Commands) ---
+        # Due key-ups / strum notes are posted on the way; whatever is still held when the
+        # chord is due gets released first, so a key never re-presses while down.
+        while pending and pending[0][0] < clock.deadline(chord_secs[i]):
+            interrupted = wait_for_playback(clock.song_time(pending[0][0]), clock, total_duration, tempo_map, flush_pending)
+            if interrupted: break
+            flush_pending(time.perf_counter())
+        flush_pending()
+        if not interrupted:
+            interrupted = wait_for_playback(chord_secs[i], clock, total_duration, tempo_map)
+        if interrupted: break
+
+        # --- PLAY NOTES ---
+        if state["muted"]: continue
+        if hwnd is None:
+            hwnd = output.target # A background re-resolve may have found the window by now
+            if hwnd is None: continue
+        if not paced:
+            if reserve(chord_start[i + 1] - chord_start[i]): dash["delayed"] += chord_notes[i]
+            chord_time = time.perf_counter()
+            send_batch(hwnd, msgs, wparams, lparams, chord_start[i], chord_start[i + 1])
+        else:
+            chord_time = time.perf_counter()
+            for j in range(chord_start[i], chord_start[i + 1]):
+                if offsets[j] <= 0:
+                    if reserve(1) and flags[j] & ACT_STRUM: dash["delayed"] += 1
+                    send(hwnd, msgs[j], wparams[j], lparams[j])
+                else: heapq.heappush(pending, (chord_time + offsets[j], j))
+        record_chord(i, chord_notes[i], clock.deadline(chord_secs[i]), chord_time, time.perf_counter())
+
+        # --- START LATENCY: prepare + window lookup + lateness of the first note (cold vs warm) ---
+        if first_note:
+            first_note = False
+            overhead = (clock.origin - song_start) + max(0.0, time.perf_counter() - clock.deadline(chord_secs[i]))
+            dash["start_ms"] = overhead * 1000; dash["load_source"] = load_source
+
+    flush_pending() # Never leave a key or modifier held past the song / an interrupt
+    return interrupted
 
 def playback_worker():
     last_path = None
+    limiter = RateLimiter() # Shared across songs: the game's input budget doesn't reset between them
+    if CONFIG["stats_gc"]: gc.callbacks.append(STATS.on_gc)
+    def idle(timeout=None):
+        """No song to play: block on the command queue and apply whatever arrives."""
+        command = COMMANDS.get(timeout)
+        if not command: return
+        if command[0] == "pause": state["paused"] = not state["paused"]
+        else: apply_command(*command)
+
     while state["running"]:
-        # Race Condition Fix: Reset flag at START of loop
-        state["restart_flag"] = False
+        song_start = time.perf_counter()
 
-        if not state["playlist"]: time.sleep(1); continue
+        if not state["playlist"]: idle(); continue
         
         full_path = state["playlist"][state["current_index"]]
         
         # --- RESET SPEED ON TRACK CHANGE ---
         if full_path != last_path:
+            if last_path: STATS.dump(os.path.basename(last_path))
+            STATS.reset(); ENSEMBLE.reset()
             state["playback_speed"] = 1.0
+            state["dashboard"]["start_ms"] = None; state["dashboard"]["delayed"] = 0
             last_path = full_path
 
-        state["dashboard"]["song"] = os.path.basename(full_path)
+        state["dashboard"]["song"] = full_path
 
         # --- PREPARE DATA (Refactored) ---
-        mid, events_by_time, total_duration, _, _, tempo = prepare_midi_data(full_path, state["manual_track_indices"])
+        # Cached: seeks, loops and mixer round-trips reuse the parsed song & timeline
+        prepare_start = time.perf_counter()
+        song, timeline, total_duration, _, _, tempo_map = prepare_midi_data(full_path, state["manual_track_indices"])
+        STATS.prepare.record(int((time.perf_counter() - prepare_start) * 1e6))
         
-        if not mid or not events_by_time:
-            time.sleep(1); continue
+        if not song or not timeline["times"]:
+            idle(1.0); continue
+        state["now_playing"] = (song, timeline)
+
+        request_prefetch()
+        if CONFIG["ensemble_parts"] > 1: interrupted = play_ensemble(song, full_path, timeline, tempo_map, total_duration, song_start)
+        else: interrupted = play_solo(timeline, tempo_map, total_duration, song_start, limiter)
+
+        # Save speed changes / the chosen transposition if any occurred (before the mixer can change them)
+        entry = get_selection(song, full_path)
+        if state["playback_speed"] != 1.0 or (entry.get("transpose") or 0) != timeline["transpose"]:
+            changes = {"transpose": timeline["transpose"]}
+            if state["playback_speed"] != 1.0: changes["speed"] = state["playback_speed"]
+            if entry != dict(entry, **changes): save_selection(song, full_path, **changes) # Only queues: never blocks the tick loop
+
+        # --- MIXER: position is saved; park until the console sends "restart" (other commands still apply) ---
+        if interrupted == "mixer":
+            UI_COMMANDS.put("mixer", full_path)
+            while state["running"]:
+                kind, arg, stamp = COMMANDS.get()
+                if kind == "pause": state["paused"] = not state["paused"]; continue
+                position = tick_to_seconds(tempo_map, state["resume_from_tick"])
+                if apply_command(kind, arg, stamp, position, total_duration, tempo_map) in ("restart", "stop"): break
 
-        state["game_hwnd"] = get_game_hwnd()
-        
-        sorted_times = sorted(events_by_time.keys())
-        prev_tick = 0
-        
-        # If resuming, calculate starting time for UI
-        accumulated_time = 0.0
-        if state["resume_from_tick"] > 0:
-            accumulated_time = mido.tick2second(state["resume_from_tick"], mid.ticks_per_beat, tempo)
-
-        # --- TICK LOOP ---
-        for current_tick in sorted_times:
-            if state["restart_flag"] or not state["running"]: break
-            
-            # --- SEEKING LOGIC (The Fix) ---
-            if current_tick < state["resume_from_tick"]:
-                prev_tick = current_tick
-                continue
-            
-            # --- CRITICAL FIX: ALIGN PREV_TICK ---
-            if state["resume_from_tick"] > 0:
-                prev_tick = state["resume_from_tick"]
-                state["resume_from_tick"] = 0
-
-            # --- MIXER INTERRUPT (CHECK #1: Before Waiting) ---
-            if state["request_track_mixer"]:
-                state["resume_from_tick"] = current_tick
-                state["player_ready_for_mixer"].set() 
-                state["mixer_ready_event"].clear()
-                while state["request_track_mixer"] and state["running"]:
-                    state["mixer_ready_event"].wait(timeout=0.1)
-                break 
-
-            # --- CALCULATE DELTA ---
-            delta_ticks = current_tick - prev_tick
-            if delta_ticks > 0:
-                real_wait = mido.tick2second(delta_ticks, mid.ticks_per_beat, tempo)
-                accumulated_time += real_wait
-                
-                # --- WAIT (Handles Speed/Pause/Input) ---
-                if accumulated_time < state["resume_from_tick"]: # Visual seek only
-                     if int(accumulated_time * 100) % 2 == 0: 
-                         update_dashboard(accumulated_time, total_duration, is_seeking=True)
-                else:
-                    interrupted = wait_for_playback(real_wait, accumulated_time, total_duration, mid, tempo)
-                    
-                    # --- MIXER INTERRUPT (CHECK #2: After Waiting) ---
-                    # Crucial Fix: If interrupted by mixer while sleeping, save position NOW.
-                    if interrupted and state["request_track_mixer"]:
-                         state["resume_from_tick"] = current_tick
-                         state["player_ready_for_mixer"].set()
-                         state["mixer_ready_event"].clear()
-                         while state["request_track_mixer"] and state["running"]:
-                             state["mixer_ready_event"].wait(timeout=0.1)
-                         break
-
-                    if interrupted: break
-
-            # --- PLAY NOTES ---
-            for note in events_by_time[current_tick]:
-                if note in NOTE_MAP and not state["muted"]:
-                    mod, key = NOTE_MAP[note]
-                    press_atomic(mod, key)
-                    if CONFIG["chord_strum_delay"] > 0: time.sleep(CONFIG["chord_strum_delay"])
-            
-            prev_tick = current_tick
-        
         # --- END OF SONG ---
-        if not state["restart_flag"] and not state["request_track_mixer"] and state["running"]:
-             state["resume_from_tick"] = 0
-             if not state["looping"]: next_song()
-             time.sleep(1)
-        
-        # Save speed changes if any occurred
-        if state["playback_speed"] != 1.0:
-            fname = os.path.basename(full_path)
-            if fname not in state["track_db"]: state["track_db"][fname] = {}
-            if isinstance(state["track_db"][fname], dict):
-                state["track_db"][fname]["speed"] = state["playback_speed"]
-            save_track_db()
+        elif not interrupted and state["running"]:
+            state["resume_from_tick"] = 0
+            if not state["looping"]: # Already prefetched: starts gapless
+                state["current_index"] = (state["current_index"] + 1) % len(state["playlist"])
+                state["manual_track_indices"] = None
+
+    if last_path: STATS.dump(os.path.basename(last_path))
+    if STATS.on_gc in gc.callbacks: gc.callbacks.remove(STATS.on_gc)
+
+# ============================================================================
+# 12. HEADLESS COMMANDS
+# ============================================================================
+def run_analyze(args):
+    """`jukebox.py analyze`: index + analyse the whole library on a process pool, with progress and resume."""
+    if args.root: CONFIG["midi_root"] = args.root
+    con = library_db()
+    if args.restart: con.execute("UPDATE files SET analysed = 0"); con.commit()
+
+    changed = rescan_library()
+    total = con.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+    todo = con.execute("SELECT COUNT(*) FROM files WHERE analysed = 0").fetchone()[0]
+    print(f"📚 {total} files in index ({changed} new/changed), {todo} to analyse, {total - todo} already done")
+
+    started = time.perf_counter(); last_print = [0.0]
+    def progress(done, count):
+        now = time.perf_counter()
+        if done < count and now - last_print[0] < 0.2: return
+        last_print[0] = now
+        elapsed = now - started; rate = done / elapsed if elapsed else 0.0
+        eta = (count - done) / rate if rate else 0.0
+        sys.stdout.write(f"\r[{done:>6} / {count}] {rate:7.1f} files/s | ETA {format_time(eta)}   "); sys.stdout.flush()
+    try:
+        done = fill_library_metadata(progress, args.workers or os.cpu_count())
+    except KeyboardInterrupt:
+        print("\n⏸  Interrupted. Finished files are saved; run again to resume.")
+        return
+    elapsed = time.perf_counter() - started
+    if done: print(f"\n✅ Analysed {done} files in {elapsed:.1f}s ({done / elapsed:.1f} files/s)")
+
+    if args.report:
+        report = {}
+        for path, analysed, analysis in con.execute("SELECT path, analysed, analysis FROM files ORDER BY path"):
+            report[path] = json.loads(analysis) if analysed == 1 else None
+        with open(args.report, "w", encoding="utf-8") as f: json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"📝 Report: {args.report}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="MIDI jukebox: plays MIDI files into a game window via key presses.")
+    parser.add_argument("--resume", action="store_true", help="Skip the menu and carry on where the last session stopped")
+    sub = parser.add_subparsers(dest="command")
+    analyze = sub.add_parser("analyze", help="Analyse the whole library headless (duration, tempo, tracks, range, density)")
+    analyze.add_argument("--root", help="Library root (default: CONFIG midi_root)")
+    analyze.add_argument("--workers", type=int, help="Worker processes (default: all cores)")
+    analyze.add_argument("--report", help="Also write every file's analysis to this JSON file")
+    analyze.add_argument("--restart", action="store_true", help="Re-analyse everything instead of resuming")
+    return parser.parse_args(argv)
 
 def main():
-    os.system("") 
-    load_track_db()
+    args = parse_args()
+    if args.command == "analyze": return run_analyze(args)
+
+    enable_ansi()
+    load_track_db_async() # The store, the library and the hooks all come up behind the first screen
+    refresh_library_async()
     state["playlist"] = [] 
+    state["resume_point"] = load_resume_snapshot() # A read and a stat: the song itself loads when resumed
+    if CONFIG["resume_file"]: atexit.register(save_resume_snapshot)
     
     t = threading.Thread(target=playback_worker, daemon=True)
     t.start()
+    threading.Thread(target=prefetch_worker, daemon=True).start()
+    threading.Thread(target=finish_startup, daemon=True).start()
+    renderer = Renderer(); renderer.start()
 
-    print("="*80); print("🎵 JUKEBOX STARTED"); print("="*80)
-    print("⌨️  F3:Pause F4:Stop F5:Menu F6:Mute F7:Mixer F8:Loop | PgUp/Dn: Seek | Home/End: Fine Seek | Arrows: Nav")
-    sys.stdout.write("\033[?25l") # Hide Cursor
+    # Resume straight into the dashboard, else force Menu on Start
+    if args.resume and state["resume_point"]:
+        COMMANDS.put("resume", state["resume_point"])
+        renderer.resume(); UI_SHOWN.set()
+    else: UI_COMMANDS.put("menu")
 
-    # Force Menu on Start
-    state["request_selection"] = True
-
-    last_song = ""
+    # This thread only runs menus; the renderer owns the screen in between
     while state["running"]:
-        if state["request_selection"]:
-            state["request_selection"] = False
-            run_selection_menu()
-            last_song = "" 
-
-        elif state["request_track_mixer"]:
-            run_track_mixer(state["playlist"][state["current_index"]])
-            state["request_track_mixer"] = False 
-            last_song = "" 
-
-        else:
-            curr_song = state["dashboard"]["song"]
-            
-            if curr_song != last_song and curr_song:
-                last_song = curr_song
-                os.system('cls' if os.name == 'nt' else 'clear')
-                print("="*80); print(f"🎵 NOW PLAYING: {curr_song}")
-                print(f"🎛️  Mixer: {state['dashboard']['mixer']}"); print("="*80)
-                print("\n\n"); print("="*80)
-                print("⌨️  F3:Pause F4:Stop F5:Menu F6:Mute F7:Mixer F8:Loop | PgUp/Dn: Seek | Home/End: Fine Seek | Arrows: Nav"); print("="*80)
-                sys.stdout.write("\033[?25l"); sys.stdout.write("\033[5A") 
-            
-            if curr_song:
-                print_dashboard()
-            time.sleep(0.1)
+        kind, arg, _ = UI_COMMANDS.get()
+        if kind not in ("menu", "mixer"): continue
+        renderer.suspend()
+        if kind == "menu": run_selection_menu()
+        else: run_track_mixer(arg)
+        renderer.resume()
     
-    sys.stdout.write("\033[?25h")
+    renderer.suspend()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
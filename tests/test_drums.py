@@ -0,0 +1,40 @@
+import os
+import struct
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import jukebox as jb
+
+def smf(*tracks, ticks_per_beat=96):
+    """Type-1 SMF bytes from raw MTrk event bodies (end-of-track appended)."""
+    chunks = b"".join(b"MTrk" + struct.pack(">I", len(t) + 4) + t + b"\x00\xff\x2f\x00" for t in tracks)
+    return b"MThd" + struct.pack(">IHHH", 6, 1, len(tracks), ticks_per_beat) + chunks
+
+def notes(channel, pitches):
+    return b"".join(bytes([0, 0x90 | channel, p, 80, 0x60, 0x80 | channel, p, 0]) for p in pitches)
+
+@pytest.fixture
+def drum_song(tmp_path):
+    """Conductor, a piano melody, and a drum track that sets a program on channel 10 before its notes."""
+    path = tmp_path / "drums.mid"
+    conductor = b"\x00\xff\x51\x03\x07\xa1\x20"
+    melody = b"\x00\xc0\x00" + notes(0, [60, 62, 64, 65])
+    drums = b"\x00\xc9\x00" + notes(9, [36, 38, 42] * 10)
+    path.write_bytes(smf(conductor, melody, drums))
+    return str(path)
+
+def test_read_smf_flags_drums_after_program_change(drum_song):
+    info = {t['index']: t for t in jb.read_smf(drum_song)["track_info"]}
+    assert info[2]['drum'] and info[2]['inst'] == "DRUMS (Ch10)"
+    assert not info[1]['drum'] and info[1]['inst'] == "Acoustic Grand Piano"
+
+def test_mido_flags_drums_after_program_change(drum_song):
+    pytest.importorskip("mido")
+    assert jb.parse_song_mido(drum_song)["track_info"] == jb.read_smf(drum_song)["track_info"]
+
+def test_auto_mix_skips_drums(drum_song):
+    song = jb.read_smf(drum_song)
+    assert jb.auto_mix(song) == [1]
+    assert jb.busiest_track(song) == [1]